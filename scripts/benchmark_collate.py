@@ -0,0 +1,67 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+import time
+import torch
+from torch_geometric.data import Data, Batch
+from torchmdnet.collate import Collater
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare the molecular collater with Batch.from_data_list')
+    parser.add_argument('--batch-size', type=int, default=128, help='Molecules per batch')
+    parser.add_argument('--num-batches', type=int, default=50, help='Number of timed batches')
+    parser.add_argument('--max-atoms', type=int, default=29, help='Maximum number of atoms per molecule')
+    parser.add_argument('--spectra', type=bool, default=True, help='Add uv, ir and raman spectra to the samples')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    return parser.parse_args()
+
+
+def make_sample(args):
+    # same layout as the QM9SP samples
+    num_atoms = int(torch.randint(3, args.max_atoms + 1, (1,)))
+    data = Data(
+        z=torch.randint(1, 10, (num_atoms,)),
+        pos=torch.randn(num_atoms, 3),
+        y=torch.randn(1, 1),
+        pos_target=torch.randn(num_atoms, 3),
+    )
+    if args.spectra:
+        data.uv = torch.rand(1, 701)
+        data.ir = torch.rand(1, 3501)
+        data.raman = torch.rand(1, 3501)
+    return data
+
+
+def benchmark(collate, batches):
+    collate(batches[0])  # warm-up
+    start = time.perf_counter()
+    for data_list in batches:
+        collate(data_list)
+    return (time.perf_counter() - start) / len(batches)
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    batches = [
+        [make_sample(args) for _ in range(args.batch_size)]
+        for _ in range(args.num_batches)
+    ]
+
+    # both collaters have to produce the same batch
+    collater = Collater()
+    expected, batch = Batch.from_data_list(batches[0]), collater(batches[0])
+    for key in ["z", "pos", "y", "pos_target", "batch", "ptr"] + (["uv", "ir", "raman"] if args.spectra else []):
+        assert torch.equal(expected[key], batch[key]), f"Collated {key} differs from Batch.from_data_list."
+
+    pyg_time = benchmark(Batch.from_data_list, batches)
+    fast_time = benchmark(collater, batches)
+    print(f"Batch.from_data_list: {pyg_time * 1e3:.3f} ms/batch")
+    print(f"Collater:             {fast_time * 1e3:.3f} ms/batch")
+    print(f"speedup:              {pyg_time / fast_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
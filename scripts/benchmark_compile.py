@@ -0,0 +1,71 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import time
+import torch
+from torchmdnet.models.model import create_model, CompiledForward
+from train import get_argparser
+
+
+def get_args():
+    # accepts the training arguments, e.g. a model configuration via --conf
+    parser = get_argparser()
+    parser.add_argument('--num-batches', type=int, default=20, help='Number of timed batches')
+    parser.add_argument('--num-warmup', type=int, default=10, help='Number of batches run before timing, compilation happens here')
+    parser.add_argument('--max-atoms', type=int, default=29, help='Maximum number of atoms per molecule')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to benchmark on')
+    return parser.parse_args()
+
+
+def make_batch(args, device):
+    num_atoms = torch.randint(3, args.max_atoms + 1, (args.batch_size,))
+    batch = torch.repeat_interleave(torch.arange(args.batch_size), num_atoms)
+    z = torch.randint(1, 10, (len(batch),))
+    # spread the atoms of a molecule over a few Angstrom
+    pos = torch.randn(len(batch), 3) * num_atoms[batch, None].float().pow(1 / 3)
+    spec = None
+    if args.spectra_model is not None:
+        spec = [torch.rand(args.batch_size, 701), torch.rand(args.batch_size, 3501), torch.rand(args.batch_size, 3501)]
+        spec = [s.to(device) for s in spec]
+    return z.to(device), pos.to(device), spec, batch.to(device), args.batch_size
+
+
+def run(forward, model, batches):
+    for z, pos, spec, batch, num_graphs in batches:
+        outputs = forward(z, pos, spec, batch, num_graphs)
+        loss = sum(out.float().sum() for out in outputs if isinstance(out, torch.Tensor) and out.requires_grad)
+        loss.backward()
+        model.zero_grad()
+
+
+def benchmark(forward, model, args, device):
+    run(forward, model, [make_batch(args, device) for _ in range(args.num_warmup)])
+    batches = [make_batch(args, device) for _ in range(args.num_batches)]
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    run(forward, model, batches)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return args.num_batches * args.batch_size / (time.perf_counter() - start)
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    model = create_model(vars(args)).to(device)
+    model.train()
+
+    eager = lambda z, pos, spec, batch, num_graphs: model(z, pos, spec, batch=batch)
+    compiled = CompiledForward(model, args.cutoff_upper, args.compile_bucket_size)
+
+    eager_throughput = benchmark(eager, model, args, device)
+    compiled_throughput = benchmark(compiled, model, args, device)
+    print(f"eager:    {eager_throughput:.1f} molecules/s")
+    print(f"compiled: {compiled_throughput:.1f} molecules/s")
+    print(f"speedup:  {compiled_throughput / eager_throughput:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import time
+import torch
+from torch_geometric.data import DataLoader
+from torchmdnet import datasets
+from torchmdnet.models.model import create_model, load_model
+from train import get_argparser
+from benchmark_compile import make_batch
+
+
+def get_args():
+    # accepts the training arguments, e.g. a model configuration via --conf or a checkpoint via --load-model
+    parser = get_argparser()
+    parser.add_argument('--num-batches', type=int, default=20, help='Number of timed batches')
+    parser.add_argument('--num-warmup', type=int, default=3, help='Number of batches run before timing')
+    parser.add_argument('--max-atoms', type=int, default=29, help='Maximum number of atoms per molecule (synthetic batches)')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to benchmark on')
+    return parser.parse_args()
+
+
+def get_batches(args, device):
+    if args.dataset is None:
+        return [make_batch(args, device) for _ in range(args.num_batches)]
+    # molecules of the given dataset, e.g. QM9 for fine-tuning
+    dataset = getattr(datasets, args.dataset)(args.dataset_root, dataset_arg=args.dataset_arg)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
+    batches = []
+    for data in loader:
+        spec = [data.uv, data.ir, data.raman] if "uv" in data else None
+        batches.append((data.z.to(device), data.pos.to(device), spec, data.batch.to(device), data.num_graphs))
+        if len(batches) == args.num_batches:
+            break
+    return batches
+
+
+def run(model, batches, bf16):
+    outputs = []
+    for z, pos, spec, batch, num_graphs in batches:
+        with torch.autocast(device_type=z.device.type, dtype=torch.bfloat16, enabled=bf16):
+            out, noise_pred, deriv, _, _, _ = model(z, pos, spec, batch=batch)
+        out.float().sum().backward()
+        model.zero_grad()
+        outputs.append((out.detach().float(), deriv.detach().float() if deriv is not None else None))
+    return outputs
+
+
+def timed(model, batches, bf16, args):
+    run(model, batches[: args.num_warmup], bf16)
+    if batches[0][0].device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    outputs = run(model, batches, bf16)
+    if batches[0][0].device.type == "cuda":
+        torch.cuda.synchronize()
+    num_molecules = sum(b[-1] for b in batches)
+    return outputs, num_molecules / (time.perf_counter() - start)
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    if args.load_model:
+        model = load_model(args.load_model, args=vars(args), device=device)
+    else:
+        model = create_model(vars(args)).to(device)
+    model.eval()
+
+    batches = get_batches(args, device)
+    reference, fp32_throughput = timed(model, batches, False, args)
+    outputs, bf16_throughput = timed(model, batches, True, args)
+
+    # deviation of the bf16 predictions from float32 with the same weights
+    ref_y = torch.cat([y for y, _ in reference])
+    y = torch.cat([y for y, _ in outputs])
+    print(f"throughput fp32: {fp32_throughput:.1f} molecules/s")
+    print(f"throughput bf16: {bf16_throughput:.1f} molecules/s ({bf16_throughput / fp32_throughput:.2f}x)")
+    print(f"energy MAE bf16 vs fp32: {(y - ref_y).abs().mean():.6f} (prediction std {ref_y.std():.6f})")
+    if reference[0][1] is not None:
+        ref_dy = torch.cat([dy for _, dy in reference])
+        dy = torch.cat([dy for _, dy in outputs])
+        print(f"force MAE bf16 vs fp32:  {(dy - ref_dy).abs().mean():.6f} (force std {ref_dy.std():.6f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+import time
+import torch
+from torchmdnet.embeddings import EmbeddingStore
+from torchmdnet.retrieval import IVFIndex, exact_search
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark spectrum-to-structure retrieval on an embedding store')
+    parser.add_argument('store', type=str, help='Embedding store with molecule and spectra embeddings, see extract_embeddings.py')
+    parser.add_argument('--num-lists', type=int, default=256, help='Number of clusters of the index')
+    parser.add_argument('--num-probes', type=int, nargs='+', default=[1, 4, 16, 64], help='Numbers of searched clusters to benchmark')
+    parser.add_argument('--num-queries', type=int, default=10000, help='Number of spectra queries')
+    parser.add_argument('--query-batch-size', type=int, default=1024, help='Queries per search call')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10], help='Cut-offs of recall@k')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the index')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    return parser.parse_args()
+
+
+def recall(retrieved, targets, k):
+    # fraction of queries with the target among the first k results
+    return (retrieved[:, :k] == targets[:, None]).any(dim=1).float().mean().item()
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    store = EmbeddingStore(args.store)
+    assert "spectra" in store.dims, "The store has no spectra embeddings."
+
+    molecules = torch.from_numpy(store.load("molecule")).to(device)
+    spectra = torch.from_numpy(store.load("spectra")).to(device)
+    ids = torch.from_numpy(store.index()).to(device)
+    # the spectrum of every molecule is a query, its structure the target
+    queries = torch.randperm(len(ids), device=device)[: args.num_queries]
+    k = max(args.k)
+
+    start = time.perf_counter()
+    index = IVFIndex(args.num_lists, device=device).train(molecules).add(molecules, ids)
+    print(f"built index of {len(index)} molecules with {args.num_lists} lists in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    _, exact = exact_search(molecules, spectra[queries], k)
+    exact = ids[exact]
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    print(f"exact:     {exact_qps:10.1f} queries/s  " + "  ".join(
+        f"recall@{c} {recall(exact, ids[queries], c):.4f}" for c in args.k
+    ))
+
+    for num_probes in args.num_probes:
+        index.num_probes = num_probes
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        retrieved = torch.cat([index.search(q, k)[1] for q in torch.split(spectra[queries], args.query_batch_size)])
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        qps = len(queries) / (time.perf_counter() - start)
+        # recall of the true structure and overlap with the exact top-k
+        overlap = (retrieved[:, :, None] == exact[:, None, :]).any(dim=2).float().mean().item()
+        print(f"probes {num_probes:3d}: {qps:10.1f} queries/s  " + "  ".join(
+            f"recall@{c} {recall(retrieved, ids[queries], c):.4f}" for c in args.k
+        ) + f"  exact top-{k} overlap {overlap:.4f}")
+
+
+if __name__ == "__main__":
+    main()
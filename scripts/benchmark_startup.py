@@ -0,0 +1,61 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+import os
+import re
+import subprocess
+import time
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Measure the cold-start time of train.py')
+    parser.add_argument('--num-runs', type=int, default=5, help='Number of measured interpreter starts')
+    parser.add_argument('--target', type=float, default=3.0, help='Target median start-up time in seconds, exits with an error if exceeded')
+    parser.add_argument('--num-imports', type=int, default=15, help='Number of slowest imports to show')
+    return parser.parse_args()
+
+
+def train_help(script, importtime=False):
+    # importing all modules and building the argument parser is the start-up cost of
+    # every job, --help stops right after it
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [script, "--help"]
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    assert result.returncode == 0, result.stderr
+    return elapsed, result.stderr
+
+
+def slowest_imports(importtime_output, count):
+    # lines of -X importtime: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in importtime_output.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match is not None:
+            imports.append((int(match.group(2)), len(match.group(3)), match.group(4)))
+    # top level imports only, their cumulative time includes the nested ones
+    level = min(indent for _, indent, _ in imports)
+    return sorted([i for i in imports if i[1] == level], reverse=True)[:count]
+
+
+def main():
+    args = get_args()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+
+    train_help(script)  # fills the file system cache
+    times = sorted(train_help(script)[0] for _ in range(args.num_runs))
+    median = times[len(times) // 2]
+
+    _, importtime_output = train_help(script, importtime=True)
+    print("slowest top level imports:")
+    for cumulative, _, name in slowest_imports(importtime_output, args.num_imports):
+        print(f"  {cumulative / 1e6:7.3f} s  {name}")
+
+    print(f"start-up time: median {median:.3f} s, min {times[0]:.3f} s, max {times[-1]:.3f} s (target {args.target:.3f} s)")
+    if median > args.target:
+        sys.exit(f"start-up time exceeds the target of {args.target:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
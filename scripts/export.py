@@ -0,0 +1,27 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+from torchmdnet.export import export_model
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export a checkpoint as a slim inference model')
+    parser.add_argument('checkpoint', type=str, help='Training checkpoint')
+    parser.add_argument('output', type=str, help='Path of the exported model')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the exported model')
+    parser.add_argument('--derivative', type=bool, default=None, help='Also return forces, defaults to the setting of the checkpoint')
+    parser.add_argument('--check', type=bool, default=True, help='Reload the exported model and compare it with the checkpoint')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    kwargs = dict() if args.derivative is None else dict(derivative=args.derivative)
+    model = export_model(args.checkpoint, args.output, device=args.device, check=args.check, **kwargs)
+    print(model)
+    print(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+import time
+import torch
+from torch_geometric.data import DataLoader
+from torchmdnet import datasets
+from torchmdnet.models.model import load_model
+from torchmdnet.embeddings import EmbeddingWriter
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Extract molecule and spectra embeddings of a dataset')
+    parser.add_argument('checkpoint', type=str, help='Training checkpoint')
+    parser.add_argument('output', type=str, help='Directory of the embedding store')
+    parser.add_argument('--dataset', type=str, required=True, choices=datasets.__all__, help='Name of the torch_geometric dataset')
+    parser.add_argument('--dataset-root', type=str, default='~/data', help='Data storage directory')
+    parser.add_argument('--dataset-arg', type=str, default=None, help='Additional dataset argument, e.g. target property for QM9 or molecule for MD17')
+    parser.add_argument('--batch-size', type=int, default=1024, help='Molecules per inference batch')
+    parser.add_argument('--num-workers', type=int, default=8, help='Number of processes loading and collating the data')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run the model on')
+    parser.add_argument('--shard-size', type=int, default=100000, help='Number of molecules per shard of the store')
+    parser.add_argument('--spectra', type=bool, default=True, help='Also extract spectra embeddings if the model and dataset have spectra')
+    return parser.parse_args()
+
+
+def get_spectra(data):
+    # same spectra as LNNP.step
+    if ("uv" in data) and ("ir" in data) and ("raman" in data):
+        return [data.uv, data.ir, data.raman]
+    if ("ir" in data) and ("h_nmr" in data) and ("c_nmr" in data):
+        return [data.ir, data.h_nmr, data.c_nmr]
+    return None
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+    model = load_model(args.checkpoint, device=device).eval()
+
+    dataset = getattr(datasets, args.dataset)(args.dataset_root, dataset_arg=args.dataset_arg)
+    spectra = args.spectra and model.representation_spec_model is not None and get_spectra(dataset[0]) is not None
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+    )
+
+    writer, start, num_molecules = None, time.perf_counter(), 0
+    with torch.inference_mode():
+        for data in loader:
+            data = data.to(device, non_blocking=True)
+            embeddings = dict(molecule=model.molecule_embedding(data.z, data.pos, data.batch))
+            if spectra:
+                embeddings["spectra"] = model.spectra_embedding(get_spectra(data))
+            embeddings = {name: value.half().cpu().numpy() for name, value in embeddings.items()}
+
+            if writer is None:
+                dims = {name: value.shape[1] for name, value in embeddings.items()}
+                meta = dict(checkpoint=args.checkpoint, dataset=args.dataset, dataset_arg=args.dataset_arg)
+                writer = EmbeddingWriter(args.output, dims, shard_size=args.shard_size, meta=meta)
+            # the loader is not shuffled, molecules are indexed by their position in the dataset
+            writer.write(range(num_molecules, num_molecules + data.num_graphs), **embeddings)
+            num_molecules += data.num_graphs
+
+    if writer is not None:
+        writer.close()
+    print(f"extracted {num_molecules} molecules in {time.perf_counter() - start:.1f} s to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
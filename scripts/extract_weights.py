@@ -0,0 +1,22 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+from torchmdnet.models.model import extract_weights
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Strip a training checkpoint down to the model weights and hyperparameters')
+    parser.add_argument('checkpoint', type=str, help='Training checkpoint')
+    parser.add_argument('output', type=str, help='Path of the compact weights file')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    extract_weights(args.checkpoint, args.output)
+    print(f"saved weights to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import sys
+
+sys.path.append(sys.path[0]+'/..')
+import argparse
+from os.path import join
+from torch.utils.tensorboard import SummaryWriter
+from torchmdnet.loggers import read_metrics
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Convert the metrics of the local logger to TensorBoard')
+    parser.add_argument('log_dir', type=str, help='Directory with metrics.bin and metrics-keys.txt')
+    parser.add_argument('--output', type=str, default=None, help='TensorBoard log directory, defaults to <log_dir>/tensorboard')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    output = join(args.log_dir, "tensorboard") if args.output is None else args.output
+    metrics = read_metrics(args.log_dir)
+
+    writer = SummaryWriter(output)
+    for key, (steps, values) in metrics.items():
+        for step, value in zip(steps.tolist(), values.tolist()):
+            writer.add_scalar(key, value, global_step=step if step >= 0 else None)
+    writer.close()
+    print(f"converted {len(metrics)} metrics to {output}")
+
+
+if __name__ == "__main__":
+    main()
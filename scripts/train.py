@@ -5,22 +5,11 @@ sys.path.append(sys.path[0]+'/..')
 import os
 import argparse
 import logging
-import pytorch_lightning as pl
-from pytorch_lightning.callbacks import EarlyStopping
-from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
-from pytorch_lightning.loggers import CSVLogger, WandbLogger
-from pytorch_lightning.plugins import DDPPlugin
-from pytorch_lightning.utilities import rank_zero_only
-from torchmdnet.module import LNNP
 from torchmdnet import datasets, priors, models
-from torchmdnet.data import DataModule
-from torchmdnet.models import output_modules
-from torchmdnet.models.utils import rbf_class_mapping, act_class_mapping
-from torchmdnet.utils import LoadFromFile, LoadFromCheckpoint, save_argparse, number
+from torchmdnet.utils import LoadFromFile, LoadFromCheckpoint, save_argparse, number, precision
 from pathlib import Path
-import wandb
 
-def get_args():
+def get_argparser():
     # fmt: off
     parser = argparse.ArgumentParser(description='Training')
     parser.add_argument('--load-model', action=LoadFromCheckpoint, help='Restart training using a model checkpoint')  # keep first
@@ -29,6 +18,7 @@ def get_args():
     parser.add_argument('--num-steps', default=None, type=int, help='Maximum number of gradient steps.')
     parser.add_argument('--batch-size', default=32, type=int, help='batch size')
     parser.add_argument('--inference-batch-size', default=None, type=int, help='Batchsize for validation and tests.')
+    parser.add_argument('--accumulate-grad-batches', default=1, type=int, help='Number of micro-batches whose gradients are accumulated per optimizer step')
     parser.add_argument('--lr', default=1e-4, type=float, help='learning rate')
     parser.add_argument('--lr-schedule', default="reduce_on_plateau", type=str, choices=['cosine', 'reduce_on_plateau'], help='Learning rate schedule.')
     parser.add_argument('--lr-patience', type=int, default=10, help='Patience for lr-schedule. Patience per eval-interval of validation')
@@ -42,7 +32,7 @@ def get_args():
     parser.add_argument('--ema-alpha-dy', type=float, default=1.0, help='The amount of influence of new losses on the exponential moving average of dy')
     parser.add_argument('--ngpus', type=int, default=-1, help='Number of GPUs, -1 use all available. Use CUDA_VISIBLE_DEVICES=1, to decide gpus')
     parser.add_argument('--num-nodes', type=int, default=1, help='Number of nodes')
-    parser.add_argument('--precision', type=int, default=32, choices=[16, 32], help='Floating point precision')
+    parser.add_argument('--precision', type=precision, default=32, choices=[16, 32, 'bf16'], help='Floating point precision, bf16 runs the model under bfloat16 autocast')
     parser.add_argument('--log-dir', '-l', default='/tmp/logs', help='log file')
     parser.add_argument('--splits', default=None, help='Npz with splits idx_train, idx_val, idx_test')
     parser.add_argument('--train-size', type=number, default=None, help='Percentage/number of samples in training set (None to use all remaining samples)')
@@ -53,8 +43,22 @@ def get_args():
     parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
     parser.add_argument('--distributed-backend', default='ddp', help='Distributed backend: dp, ddp, ddp2')
     parser.add_argument('--num-workers', type=int, default=4, help='Number of workers for data prefetch')
+    parser.add_argument('--persistent-workers', type=bool, default=True, help='Keep the data loader workers alive between epochs')
+    parser.add_argument('--prefetch-factor', type=int, default=2, help='Number of batches loaded in advance by each worker')
+    parser.add_argument('--pin-memory', type=bool, default=True, help='Load batches into pinned memory')
+    parser.add_argument('--device-prefetch', type=bool, default=False, help='Copy the next batch to the GPU on a side stream while the current batch is processed')
+    parser.add_argument('--fast-collate', type=bool, default=False, help='Collate batches with the specialized molecular collater and fetch the samples of a batch at once')
+    parser.add_argument('--metrics-sync-interval', type=int, default=50, help='Number of training steps over which the per-step metrics are accumulated before they are reduced over ranks and logged')
+    parser.add_argument('--profile-stages', type=bool, default=False, help='Profile the stages of the training step and write a Chrome trace and a CSV summary to log_dir')
+    parser.add_argument('--profile-wait', type=int, default=10, help='Number of training steps before profiling starts')
+    parser.add_argument('--profile-steps', type=int, default=20, help='Number of profiled training steps')
+    parser.add_argument('--compile', type=bool, default=False, help='Compile the model forward pass and the contrastive loss with torch.compile')
+    parser.add_argument('--compile-bucket-size', type=int, default=64, help='Pad the atoms of a batch to a multiple of this when compiling, 0 to disable padding')
     parser.add_argument('--redirect', type=bool, default=False, help='Redirect stdout and stderr to log_dir/log')
+    parser.add_argument('--logger', type=str, nargs='+', default=['tensorboard', 'csv', 'wandb'], choices=['local', 'tensorboard', 'csv', 'wandb'], help='Loggers of the run, local writes a binary metrics file from a background thread and needs no network')
     parser.add_argument('--wandb-notes', default="", type=str, help='Notes passed to wandb experiment.')
+    parser.add_argument('--log-code', type=bool, default=True, help='Upload the source code of the run to wandb, if it is used')
+    parser.add_argument('--log-code-dirs', type=str, nargs='+', default=['torchmdnet', 'scripts', 'examples'], help='Directories of the repository whose .py and .yaml files are uploaded with --log-code')
     parser.add_argument('--job-id', default="auto", type=str, help='Job ID. If auto, pick the next available numeric job id.')
     parser.add_argument('--pretrained-model', default=None, type=str, help='Pre-trained weights checkpoint.')
 
@@ -66,6 +70,8 @@ def get_args():
     parser.add_argument('--embed-files', default=None, type=str, help='Custom embedding files glob')
     parser.add_argument('--energy-files', default=None, type=str, help='Custom energy files glob')
     parser.add_argument('--force-files', default=None, type=str, help='Custom force files glob')
+    parser.add_argument('--streaming', type=bool, default=False, help='Stream the training set shard by shard instead of indexing it (Custom and HDF5 datasets only)')
+    parser.add_argument('--stream-buffer-size', type=int, default=10000, help='Number of consecutive samples shuffled together when streaming')
     parser.add_argument('--energy-weight', default=1.0, type=float, help='Weighting factor for energies in the loss function')
     parser.add_argument('--force-weight', default=1.0, type=float, help='Weighting factor for forces in the loss function')
     parser.add_argument('--position-noise-scale', default=0., type=float, help='Scale of Gaussian noise added to positions.')
@@ -76,23 +82,23 @@ def get_args():
     
     # model architecture
     parser.add_argument('--model', type=str, default='graph-network', choices=models.__all__, help='Which model to train')
-    parser.add_argument('--output-model', type=str, default='Scalar', choices=output_modules.__all__, help='The type of output model')
+    parser.add_argument('--output-model', type=str, default='Scalar', choices=models.output_models, help='The type of output model')
     parser.add_argument('--prior-model', type=str, default=None, choices=priors.__all__, help='Which prior model to use')
-    parser.add_argument('--output-model-noise', type=str, default=None, choices=output_modules.__all__ + ['VectorOutput'], help='The type of output model for denoising')
+    parser.add_argument('--output-model-noise', type=str, default=None, choices=models.output_models + ['VectorOutput'], help='The type of output model for denoising')
 
     # architectural args
     parser.add_argument('--embedding-dimension', type=int, default=256, help='Embedding dimension')
     parser.add_argument('--num-layers', type=int, default=6, help='Number of interaction layers in the model')
     parser.add_argument('--num-rbf', type=int, default=64, help='Number of radial basis functions in model')
-    parser.add_argument('--activation', type=str, default='silu', choices=list(act_class_mapping.keys()), help='Activation function')
-    parser.add_argument('--rbf-type', type=str, default='expnorm', choices=list(rbf_class_mapping.keys()), help='Type of distance expansion')
+    parser.add_argument('--activation', type=str, default='silu', choices=models.activations, help='Activation function')
+    parser.add_argument('--rbf-type', type=str, default='expnorm', choices=models.rbf_types, help='Type of distance expansion, the _tab variants are evaluated from a lookup table and require --trainable-rbf false')
     parser.add_argument('--trainable-rbf', type=bool, default=False, help='If distance expansion functions should be trainable')
     parser.add_argument('--neighbor-embedding', type=bool, default=False, help='If a neighbor embedding should be applied before interactions')
     parser.add_argument('--aggr', type=str, default='add', help='Aggregation operation for CFConv filter output. Must be one of \'add\', \'mean\', or \'max\'')
 
     # Transformer specific
     parser.add_argument('--distance-influence', type=str, default='both', choices=['keys', 'values', 'both', 'none'], help='Where distance information is included inside the attention')
-    parser.add_argument('--attn-activation', default='silu', choices=list(act_class_mapping.keys()), help='Attention activation function')
+    parser.add_argument('--attn-activation', default='silu', choices=models.activations, help='Attention activation function')
     parser.add_argument('--num-heads', type=int, default=8, help='Number of attention heads')
     parser.add_argument('--layernorm-on-vec', type=str, default=None, choices=['whitened'], help='Whether to apply an equivariant layer norm to vec features. Off by default.')
 
@@ -103,12 +109,14 @@ def get_args():
     parser.add_argument('--atom-filter', type=int, default=-1, help='Only sum over atoms with Z > atom_filter')
     parser.add_argument('--max-z', type=int, default=100, help='Maximum atomic number that fits in the embedding matrix')
     parser.add_argument('--max-num-neighbors', type=int, default=32, help='Maximum number of neighbors to consider in the network')
+    parser.add_argument('--half-edges', type=bool, default=False, help='Compute distance features once per atom pair instead of per direction (graph-network and equivariant-transformer)')
     parser.add_argument('--standardize', type=bool, default=False, help='If true, multiply prediction by dataset std and add mean')
     parser.add_argument('--reduce-op', type=str, default='add', choices=['add', 'mean'], help='Reduce operation to apply to atomic predictions')
     # fmt: on
 
-    parser.add_argument('--output-model-spec', type=str, default=None, choices=output_modules.__all__ + ['VectorOutput'], help='The type of output model for spectra feature')
-    parser.add_argument('--output-model-mol', type=str, default=None, choices=output_modules.__all__ + ['VectorOutput'], help='The type of output model for molecule feature')
+    parser.add_argument('--fuse-output-heads', type=bool, default=False, help='Compute the output, noise and molecule feature networks with fused batched matrix multiplications')
+    parser.add_argument('--output-model-spec', type=str, default=None, choices=models.output_models + ['VectorOutput'], help='The type of output model for spectra feature')
+    parser.add_argument('--output-model-mol', type=str, default=None, choices=models.output_models + ['VectorOutput'], help='The type of output model for molecule feature')
     parser.add_argument('--spectra-model', type=str, default=None, choices=models.__all__, help='Which model to train contrastive task')
     parser.add_argument('--input-data-norm-type', type=str, default='minmax', choices=['minmax', 'log', 'log10', 'None'], help='which type of norm method do you want for spectra data')
     parser.add_argument('--contrastive-weight', default=0., type=float, help='Weighting factor for contrastive learning in the loss function')
@@ -121,6 +129,11 @@ def get_args():
 
     parser.add_argument('--reduce-lr-when-bad', type=bool, default=False, help='reduce lr when the val_loss is bad')
 
+    return parser
+
+
+def get_args():
+    parser = get_argparser()
     args = parser.parse_args()
 
     if args.job_id == "auto":
@@ -149,8 +162,31 @@ def get_args():
     return args
 
 
+def code_files(root, dirs):
+    # only the given directories are walked, not logs and data in the repository
+    for directory in dirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, directory)):
+            dirnames[:] = [d for d in dirnames if d != "__pycache__" and not d.startswith(".")]
+            for filename in filenames:
+                if filename.endswith(".py") or filename.endswith(".yaml"):
+                    yield os.path.join(dirpath, filename)
+
+
 def main():
     args = get_args()
+
+    # the training modules are imported after parsing, so that the arguments are
+    # checked and --help is shown without loading the models
+    import pytorch_lightning as pl
+    from pytorch_lightning.callbacks import EarlyStopping
+    from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.utilities import rank_zero_only
+    from torchmdnet.module import LNNP
+    from torchmdnet.data import DataModule, StreamCursor
+    from torchmdnet.profiling import StageProfiler
+    from torchmdnet.loggers import LocalLogger
+
     pl.seed_everything(args.seed, workers=True)
     print(args)
 
@@ -181,27 +217,49 @@ def main():
         save_last=True,
     )
     early_stopping = EarlyStopping("val_loss", patience=args.early_stopping_patience)
+    callbacks = [checkpoint_callback]
+    if args.streaming:
+        callbacks.append(StreamCursor())
+    if args.profile_stages:
+        callbacks.append(StageProfiler(args.log_dir, wait=args.profile_wait, active=args.profile_steps))
 
-    tb_logger = pl.loggers.TensorBoardLogger(
-        args.log_dir, name="tensorbord", version="", default_hp_metric=False
-    )
-    csv_logger = CSVLogger(args.log_dir, name="", version="")
-    wandb_logger = WandbLogger(
-        name=args.job_id,
-        project="MolSpectra-0122",
-        notes=args.wandb_notes,
-        settings=wandb.Settings(start_method="fork", code_dir="."),
-    )
+    loggers = []
+    if "local" in args.logger:
+        loggers.append(LocalLogger(args.log_dir))
+    if "tensorboard" in args.logger:
+        loggers.append(pl.loggers.TensorBoardLogger(
+            args.log_dir, name="tensorbord", version="", default_hp_metric=False
+        ))
+    if "csv" in args.logger:
+        loggers.append(CSVLogger(args.log_dir, name="", version=""))
+    if "wandb" in args.logger:
+        import wandb
+        from pytorch_lightning.loggers import WandbLogger
 
-    @rank_zero_only
-    def log_code():
-        wandb_logger.experiment # runs wandb.init, so then code can be logged next
-        wandb.run.log_code(".", include_fn=lambda path: path.endswith(".py") or path.endswith(".yaml"))
+        wandb_logger = WandbLogger(
+            name=args.job_id,
+            project="MolSpectra-0122",
+            notes=args.wandb_notes,
+            settings=wandb.Settings(start_method="fork", code_dir="."),
+        )
+        loggers.append(wandb_logger)
+
+        @rank_zero_only
+        def log_code():
+            wandb_logger.experiment # runs wandb.init, so then code can be logged next
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            artifact = wandb.Artifact(f"source-{wandb.run.id}", type="code")
+            for path in code_files(root, args.log_code_dirs):
+                artifact.add_file(path, name=os.path.relpath(path, root))
+            wandb.run.log_artifact(artifact)
 
-    log_code()
+        if args.log_code:
+            log_code()
 
     ddp_plugin = None
     if "ddp" in args.distributed_backend:
+        from pytorch_lightning.plugins import DDPPlugin
+
         ddp_plugin = DDPPlugin(find_unused_parameters=False, num_nodes=args.num_nodes)
 
     trainer = pl.Trainer(
@@ -214,10 +272,15 @@ def main():
         auto_lr_find=False,
         resume_from_checkpoint=args.load_model,
         # callbacks=[early_stopping, checkpoint_callback],
-        callbacks=[checkpoint_callback],
-        logger=[tb_logger, csv_logger, wandb_logger],
+        callbacks=callbacks,
+        logger=loggers,
         reload_dataloaders_every_epoch=False,
-        precision=args.precision,
+        accumulate_grad_batches=args.accumulate_grad_batches,
+        # the data module sets up distributed samplers itself, replacing them
+        # would recreate the (persistent, prefetching) data loaders
+        replace_sampler_ddp=False,
+        # bf16 autocast is handled by LNNP, the trainer runs in float32
+        precision=32 if args.precision == "bf16" else args.precision,
         plugins=[ddp_plugin],
     )
 
@@ -1,5 +1,10 @@
+import copy
+import numpy as np
 import torch
+from ase.calculators.calculator import Calculator, all_changes
 from torchmdnet.models.model import load_model
+from torchmdnet.models.utils import Distance, VerletDistance
+from torchmdnet.inference import InferenceEngine
 
 
 class External:
@@ -17,3 +22,84 @@ class External:
         pos = pos.to(self.device).type(torch.float32).reshape(-1, 3)
         energy, forces = self.model(self.embeddings, pos, self.batch)
         return energy.detach(), forces.reshape(-1, self.n_atoms, 3).detach()
+
+
+class TorchMDNetCalculator(Calculator):
+    r"""ASE calculator predicting energies and forces with a TorchMD-Net model.
+
+    The model, the atom tensors of the last system and the neighbor list are kept
+    between calls. The distance modules of a copy of the model are replaced by
+    :class:`torchmdnet.models.utils.VerletDistance`, so the neighbor search is only
+    repeated once an atom moved more than half the Verlet skin. Many replicas, e.g.
+    NEB images, can be evaluated in a single batched forward pass with
+    :meth:`calculate_replicas`.
+
+    Args:
+        model (TorchMD_Net or str): The model or the path to a checkpoint.
+        device (str, optional): Device to run the model on. (default: :obj:`"cpu"`)
+        skin (float, optional): Verlet skin of the neighbor list in Angstrom, 0 to
+            search neighbors in every call. (default: :obj:`0.5`)
+        energy_scale (float, optional): Factor converting the model's energies to eV,
+            forces are converted with the same factor. (default: :obj:`1.0`)
+    """
+
+    implemented_properties = ["energy", "forces"]
+
+    def __init__(self, model, device="cpu", skin=0.5, energy_scale=1.0, **kwargs):
+        Calculator.__init__(self, **kwargs)
+        if skin > 0 and not isinstance(model, str):
+            # the distance modules are replaced, the caller's model stays unchanged
+            model = copy.deepcopy(model)
+        self.engine = InferenceEngine(model, device=device, forces=True)
+        self.energy_scale = energy_scale
+        if skin > 0:
+            _use_verlet_distance(self.engine.model, skin)
+        self._numbers = None
+        self._z = None
+        self._batch = None
+
+    def _graph(self, numbers, num_replicas=1):
+        # atom types and batch assignment are only rebuilt if the atoms change
+        key = (num_replicas, numbers.tobytes())
+        if self._numbers != key:
+            self._numbers = key
+            z = torch.from_numpy(numbers).long()
+            self._z = z.repeat(num_replicas)
+            self._batch = torch.arange(num_replicas).repeat_interleave(len(z))
+        return self._z, self._batch
+
+    def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        z, batch = self._graph(self.atoms.numbers)
+        pos = torch.from_numpy(self.atoms.positions).float()
+        energy, forces = self.engine.predict_batch(z, pos, batch)
+        self.results["energy"] = float(energy.sum()) * self.energy_scale
+        self.results["forces"] = forces.cpu().numpy().astype(np.float64) * self.energy_scale
+
+    def calculate_replicas(self, images):
+        r"""Evaluates several replicas of the same system in one batched forward pass.
+
+        Args:
+            images (list of ase.Atoms): The replicas, all with the same atoms.
+
+        Returns:
+            An array of the energies and an array of the forces of all replicas.
+        """
+        numbers = images[0].numbers
+        assert all(np.array_equal(image.numbers, numbers) for image in images), (
+            "All replicas must contain the same atoms."
+        )
+        z, batch = self._graph(numbers, len(images))
+        pos = torch.from_numpy(np.concatenate([image.positions for image in images])).float()
+        energy, forces = self.engine.predict_batch(z, pos, batch)
+        energies = energy.reshape(len(images), -1).sum(-1).cpu().numpy() * self.energy_scale
+        forces = forces.cpu().numpy().astype(np.float64).reshape(len(images), len(numbers), 3)
+        return energies, forces * self.energy_scale
+
+
+def _use_verlet_distance(module, skin):
+    for name, child in module.named_children():
+        if type(child) is Distance:
+            setattr(module, name, VerletDistance.from_distance(child, skin))
+        else:
+            _use_verlet_distance(child, skin)
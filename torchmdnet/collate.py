@@ -0,0 +1,120 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Subset, get_worker_info
+from torch.utils.data import DataLoader as TorchDataLoader
+from torch_geometric.data import Batch
+
+
+class Collater(object):
+    r"""Collates a list of :obj:`torch_geometric.data.Data` objects into a
+    :obj:`torch_geometric.data.Batch` like :meth:`Batch.from_data_list`, but
+    specialized for the flat sample layout of the molecular datasets (z, pos, y,
+    dy, pos_target and the spectra uv, ir, raman, h_nmr, c_nmr).
+
+    All tensor attributes are concatenated along their first dimension, 0-dim tensors
+    and Python numbers are stacked, attributes whose name contains "index" are
+    concatenated along their last dimension and shifted by the number of preceding
+    atoms. The :obj:`batch` and :obj:`ptr` vectors are computed without a loop over
+    the samples. Inside DataLoader workers the results are written to shared memory
+    directly, which saves a copy when the batch is sent to the main process.
+
+    Samples with differing attributes are collated with :meth:`Batch.from_data_list`.
+    """
+
+    node_keys = ["z", "pos", "x"]
+
+    def __call__(self, data_list):
+        items = [data.to_dict() for data in data_list]
+        keys = items[0].keys()
+        node_key = next((key for key in self.node_keys if key in keys), None)
+        if node_key is None or any(item.keys() != keys for item in items):
+            return Batch.from_data_list(data_list)
+
+        num_graphs = len(items)
+        num_nodes = torch.tensor([item[node_key].size(0) for item in items])
+        ptr = torch.zeros(num_graphs + 1, dtype=torch.long)
+        torch.cumsum(num_nodes, dim=0, out=ptr[1:])
+        batch = torch.repeat_interleave(torch.arange(num_graphs), num_nodes)
+
+        attrs = dict()
+        for key in keys:
+            values = [item[key] for item in items]
+            elem = values[0]
+            if isinstance(elem, torch.Tensor):
+                if elem.dim() == 0:
+                    attrs[key] = torch.stack(values)
+                elif "index" in key:
+                    # shift the node indices of every sample by its node offset
+                    out = _cat(values, dim=-1)
+                    counts = torch.tensor([value.size(-1) for value in values])
+                    out += torch.repeat_interleave(ptr[:-1], counts)
+                    attrs[key] = out
+                else:
+                    attrs[key] = _cat(values, dim=0)
+            elif isinstance(elem, (int, float, bool)):
+                attrs[key] = torch.tensor(values)
+            else:
+                attrs[key] = values
+
+        out = Batch(batch=batch, ptr=ptr, **attrs)
+        out._num_graphs = num_graphs
+        return out
+
+
+def _cat(tensors, dim):
+    out = None
+    if get_worker_info() is not None:
+        # concatenate into shared memory, as torch's default collate does
+        elem = tensors[0]
+        shape = list(elem.shape)
+        shape[dim] = sum(tensor.size(dim) for tensor in tensors)
+        storage = elem._typed_storage() if hasattr(elem, "_typed_storage") else elem.storage()
+        storage = storage._new_shared(int(np.prod(shape)))
+        out = elem.new(storage).resize_(*shape)
+    return torch.cat(tensors, dim=dim, out=out)
+
+
+class BatchFetch(Dataset):
+    r"""Map-style view of a dataset, which loads all samples of a batch with a
+    single :meth:`get_many` call if the underlying dataset implements it (see
+    :class:`torchmdnet.datasets.Custom` and :class:`torchmdnet.datasets.HDF5`).
+    DataLoaders call :meth:`__getitems__` with the indices of a whole batch.
+
+    Args:
+        dataset (Dataset): The dataset, optionally wrapped in a :obj:`Subset`.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        if isinstance(dataset, Subset):
+            self.base, self.indices = dataset.dataset, np.asarray(dataset.indices)
+        else:
+            self.base, self.indices = dataset, None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+    def __getitems__(self, idxs):
+        if not hasattr(self.base, "get_many"):
+            return [self.dataset[idx] for idx in idxs]
+        if self.indices is not None:
+            idxs = self.indices[idxs]
+        return self.base.get_many(idxs)
+
+
+class FastDataLoader(TorchDataLoader):
+    r"""DataLoader using :class:`Collater` and batched sample fetching through
+    :class:`BatchFetch`. Takes the same arguments as
+    :obj:`torch_geometric.data.DataLoader`."""
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, **kwargs):
+        # Remove for PyTorch Lightning, as the torch_geometric DataLoader does
+        kwargs.pop("collate_fn", None)
+        if not isinstance(dataset, IterableDataset):
+            dataset = BatchFetch(dataset)
+        super(FastDataLoader, self).__init__(
+            dataset, batch_size, shuffle, collate_fn=Collater(), **kwargs
+        )
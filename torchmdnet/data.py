@@ -1,12 +1,19 @@
-from os.path import join
+import os
+import hashlib
+from os.path import join, exists
 from tqdm import tqdm
+import numpy as np
 import torch
-from torch.utils.data import Subset
-from torch_geometric.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import Subset, IterableDataset, DistributedSampler
+from torch_geometric.data import DataLoader, InMemoryDataset
 from pytorch_lightning import LightningDataModule
+from pytorch_lightning.callbacks import Callback
 from pytorch_lightning.utilities import rank_zero_warn
 from torchmdnet import datasets
-from torchmdnet.utils import make_splits, MissingEnergyException
+from torchmdnet.datasets.stream import ShardStream
+from torchmdnet.collate import FastDataLoader
+from torchmdnet.utils import make_splits, split_sizes, MissingEnergyException
 from torch_scatter import scatter
 
 
@@ -19,6 +26,15 @@ class DataModule(LightningDataModule):
         self.dataset = dataset
 
     def setup(self, stage):
+        if self.hparams['position_noise_scale'] > 0.:
+            def transform(data):
+                noise = torch.randn_like(data.pos) * self.hparams['position_noise_scale']
+                data.pos_target = noise
+                data.pos = data.pos + noise
+                return data
+        else:
+            transform = None
+
         if self.dataset is None:
             if self.hparams["dataset"] == "Custom":
                 self.dataset = datasets.Custom(
@@ -27,16 +43,8 @@ class DataModule(LightningDataModule):
                     self.hparams["energy_files"],
                     self.hparams["force_files"],
                 )
+                self.dataset_maybe_noisy = self.dataset
             else:
-                if self.hparams['position_noise_scale'] > 0.:
-                    def transform(data):
-                        noise = torch.randn_like(data.pos) * self.hparams['position_noise_scale']
-                        data.pos_target = noise
-                        data.pos = data.pos + noise
-                        return data
-                else:
-                    transform = None
-
                 dataset_factory = lambda t: getattr(datasets, self.hparams["dataset"])(self.hparams["dataset_root"], dataset_arg=self.hparams["dataset_arg"], transform=t)
 
                 # Noisy version of dataset
@@ -44,6 +52,19 @@ class DataModule(LightningDataModule):
                 # Clean version of dataset
                 self.dataset = dataset_factory(None)
 
+        if self.hparams["atom_filter"] > -1:
+            if not _check_atom_filter(self.dataset, self.hparams["atom_filter"]):
+                # datasets that are not collated in memory are checked sample by sample
+                # while loading, in the DataLoader workers
+                threshold = self.hparams["atom_filter"]
+                _add_atom_filter_check(self.dataset, threshold)
+                _add_atom_filter_check(self.dataset_maybe_noisy, threshold)
+                transform = _AtomFilterCheck(threshold, transform)
+
+        if self.hparams["streaming"]:
+            self._setup_streaming(transform)
+            return
+
         self.idx_train, self.idx_val, self.idx_test = make_splits(
             len(self.dataset),
             self.hparams["train_size"],
@@ -70,7 +91,44 @@ class DataModule(LightningDataModule):
         if self.hparams["standardize"]:
             self._standardize()
 
+    def _setup_streaming(self, transform):
+        assert hasattr(self.dataset, "shard_sizes"), (
+            f"Streaming is not supported by the {self.hparams['dataset']} dataset."
+        )
+        # splits are contiguous, the training samples are streamed shard by shard
+        # and the validation and test samples are indexed
+        train_size, val_size, test_size = split_sizes(
+            len(self.dataset),
+            self.hparams["train_size"],
+            self.hparams["val_size"],
+            self.hparams["test_size"],
+        )
+        self.idx_train = None
+        self.idx_val = torch.arange(train_size, train_size + val_size)
+        self.idx_test = torch.arange(train_size + val_size, train_size + val_size + test_size)
+        print(f"train {train_size} (streamed), val {val_size}, test {test_size}")
+
+        self.train_dataset = ShardStream(
+            self.dataset,
+            stop=train_size,
+            buffer_size=self.hparams["stream_buffer_size"],
+            seed=self.hparams["seed"],
+            transform=transform,
+        )
+        self.val_dataset = Subset(self.dataset, self.idx_val)
+        self.test_dataset = Subset(self.dataset, self.idx_test)
+
+        if self.hparams["standardize"]:
+            self._standardize()
+
     def train_dataloader(self):
+        if isinstance(self.train_dataset, ShardStream):
+            self.train_dataset.set_distributed(
+                self.trainer.global_rank,
+                self.trainer.world_size,
+                self.hparams["num_workers"],
+                self.hparams["batch_size"],
+            )
         return self._get_dataloader(self.train_dataset, "train")
 
     def val_dataloader(self):
@@ -110,17 +168,42 @@ class DataModule(LightningDataModule):
 
         if stage == "train":
             batch_size = self.hparams["batch_size"]
-            shuffle = True
+            # streamed datasets shuffle themselves
+            shuffle = not isinstance(dataset, IterableDataset)
         elif stage in ["val", "test"]:
             batch_size = self.hparams["inference_batch_size"]
             shuffle = False
 
-        dl = DataLoader(
+        sampler = None
+        if dist.is_available() and dist.is_initialized() and not isinstance(dataset, IterableDataset):
+            # the trainer does not replace samplers (see replace_sampler_ddp in train.py)
+            sampler = DistributedSampler(dataset, shuffle=shuffle)
+            shuffle = False
+
+        num_workers = self.hparams["num_workers"]
+        worker_args = dict()
+        if num_workers > 0:
+            worker_args["prefetch_factor"] = self.hparams["prefetch_factor"]
+            # keep the worker pools of the stored loaders alive between epochs, streamed
+            # datasets have to be forked again to see the new epoch
+            worker_args["persistent_workers"] = (
+                self.hparams["persistent_workers"]
+                and store_dataloader
+                and not isinstance(dataset, IterableDataset)
+            )
+
+        if self.hparams["fast_collate"]:
+            loader_class = FastDevicePrefetchLoader if self.hparams["device_prefetch"] else FastDataLoader
+        else:
+            loader_class = DevicePrefetchLoader if self.hparams["device_prefetch"] else DataLoader
+        dl = loader_class(
             dataset=dataset,
             batch_size=batch_size,
             shuffle=shuffle,
-            num_workers=self.hparams["num_workers"],
-            pin_memory=True,
+            sampler=sampler,
+            num_workers=num_workers,
+            pin_memory=self.hparams["pin_memory"],
+            **worker_args,
         )
 
         if store_dataloader:
@@ -128,6 +211,52 @@ class DataModule(LightningDataModule):
         return dl
 
     def _standardize(self):
+        # only remove atomref energies if the atomref prior is used
+        atomref = self.atomref if self.hparams["prior_model"] == "Atomref" else None
+
+        cache_path = join(self.hparams["log_dir"], f"stats-{self._stats_key(atomref)}.pt")
+        if exists(cache_path):
+            self._mean, self._std = torch.load(cache_path)
+            print(f"y mean: {self.mean}; y std: {self.std} (loaded from {cache_path})")
+            return
+
+        try:
+            ys = _dataset_energies(self.dataset, self.idx_train, atomref)
+            if ys is None:
+                ys = self._loader_energies(atomref)
+        except MissingEnergyException:
+            rank_zero_warn(
+                "Standardize is true but failed to compute dataset mean and "
+                "standard deviation. Maybe the dataset only contains forces."
+            )
+            return
+
+        # compute mean and standard deviation
+        self._mean = ys.mean(dim=0)
+        self._std = ys.std(dim=0)
+        print(f"y mean: {self.mean}; y std: {self.std}")
+
+        # write atomically, other ranks may be reading the cache at the same time
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save((self._mean, self._std), tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    def _stats_key(self, atomref):
+        # the statistics depend on the data, the training split and the prior
+        key = hashlib.sha1()
+        for name in ["dataset", "dataset_root", "dataset_arg", "coord_files", "energy_files", "prior_model"]:
+            key.update(repr(self.hparams.get(name)).encode())
+        key.update(repr(len(self.dataset)).encode())
+        if self.idx_train is not None:
+            key.update(np.ascontiguousarray(self.idx_train.numpy()).tobytes())
+        else:
+            # streamed training sets are defined by the split sizes
+            for name in ["train_size", "val_size", "test_size", "seed"]:
+                key.update(repr(self.hparams.get(name)).encode())
+        key.update(repr(atomref is not None).encode())
+        return key.hexdigest()[:16]
+
+    def _loader_energies(self, atomref):
         def get_energy(batch, atomref):
             if batch.y is None:
                 raise MissingEnergyException()
@@ -143,19 +272,171 @@ class DataModule(LightningDataModule):
             self._get_dataloader(self.train_dataset, "val", store_dataloader=False),
             desc="computing mean and std",
         )
-        try:
-            # only remove atomref energies if the atomref prior is used
-            atomref = self.atomref if self.hparams["prior_model"] == "Atomref" else None
-            # extract energies from the data
-            ys = torch.cat([get_energy(batch, atomref) for batch in data])
-        except MissingEnergyException:
-            rank_zero_warn(
-                "Standardize is true but failed to compute dataset mean and "
-                "standard deviation. Maybe the dataset only contains forces."
+        # extract energies from the data
+        return torch.cat([get_energy(batch, atomref) for batch in data])
+
+
+def _collated_storage(dataset):
+    r"""Returns the collated data and slices of an in-memory dataset that stores all of
+    its samples in a single storage, :obj:`None` for other datasets. Datasets with
+    several storages, such as MD17, only load one of them into :obj:`data` and
+    :obj:`slices` on access and are excluded."""
+    if not isinstance(dataset, InMemoryDataset) or hasattr(dataset, "data_all"):
+        return None
+    if getattr(dataset, "_indices", None) is not None or dataset.slices is None:
+        return None
+    data = dataset._data if hasattr(dataset, "_data") else dataset.data
+    if data is None or len(dataset.slices) == 0:
+        return None
+    slices = next(iter(dataset.slices.values()))
+    if len(slices) - 1 != len(dataset):
+        return None
+    return data, dataset.slices
+
+
+def _dataset_energies(dataset, idx, atomref):
+    r"""Extracts the (atomref corrected) energies of the samples :obj:`idx` directly from
+    the collated storage of an in-memory dataset. Returns :obj:`None` if the dataset
+    is not stored that way."""
+    storage = _collated_storage(dataset)
+    if idx is None or storage is None:
+        return None
+    data, slices = storage
+    if "y" not in slices or "z" not in slices:
+        raise MissingEnergyException()
+
+    # only one row of y per sample can be read without collating samples
+    y_slices = slices["y"]
+    if not bool(((y_slices[1:] - y_slices[:-1]) == 1).all()):
+        return None
+    y = data.y[y_slices[:-1]]
+    if hasattr(dataset, "label_idx"):
+        # mirror the label filter transform of the QM9 datasets
+        y = y[:, dataset.label_idx].unsqueeze(1)
+    y = y[idx]
+
+    if atomref is None:
+        return y.clone()
+
+    # remove atomref energies from the target energy
+    num_atoms = slices["z"][1:] - slices["z"][:-1]
+    atom_batch = torch.repeat_interleave(torch.arange(len(num_atoms)), num_atoms)
+    atomref_energy = scatter(atomref[data.z], atom_batch, dim=0, dim_size=len(num_atoms))
+    return (y.squeeze() - atomref_energy[idx].squeeze()).clone()
+
+
+def _check_atom_filter(dataset, threshold):
+    r"""Makes sure that the atom filter keeps at least one atom of every molecule, so
+    that the model does not have to check it. Only datasets collated in memory can be
+    checked at once, returns whether the dataset was checked."""
+    storage = _collated_storage(dataset)
+    if storage is None or "z" not in storage[1]:
+        return False
+    data, slices = storage
+    num_atoms = slices["z"][1:] - slices["z"][:-1]
+    atom_batch = torch.repeat_interleave(torch.arange(len(num_atoms)), num_atoms)
+    num_kept = scatter((data.z > threshold).long(), atom_batch, dim=0, dim_size=len(num_atoms))
+    if not bool((num_kept > 0).all()):
+        raise ValueError(
+            f"{int((num_kept == 0).sum())} samples are completely filtered out by the atom filter. "
+            f"Make sure that at least one atom per sample exists with Z > {threshold}."
+        )
+    return True
+
+
+class _AtomFilterCheck(object):
+    # transform raising an error for samples without atoms left by the atom filter
+    def __init__(self, threshold, transform=None):
+        self.threshold = threshold
+        self.transform = transform
+
+    def __call__(self, data):
+        if not bool((data.z > self.threshold).any()):
+            raise ValueError(
+                "A sample was completely filtered out by the atom filter. "
+                f"Make sure that at least one atom per sample exists with Z > {self.threshold}."
             )
+        return data if self.transform is None else self.transform(data)
+
+
+def _add_atom_filter_check(dataset, threshold):
+    if not isinstance(dataset.transform, _AtomFilterCheck):
+        dataset.transform = _AtomFilterCheck(threshold, dataset.transform)
+
+
+def _record_stream(tensor, stream):
+    tensor.record_stream(stream)
+    return tensor
+
+
+class DevicePrefetchMixin(object):
+    r"""DataLoader mixin that copies the next batch to the current CUDA device on a
+    side stream while the current batch is processed. Batches stay on the CPU if CUDA
+    is not available. Copies only overlap with compute if :obj:`pin_memory` is set."""
+
+    def __iter__(self):
+        iterator = super(DevicePrefetchMixin, self).__iter__()
+        if not torch.cuda.is_available():
+            yield from iterator
             return
 
-        # compute mean and standard deviation
-        self._mean = ys.mean(dim=0)
-        self._std = ys.std(dim=0)
-        print(f"y mean: {self.mean}; y std: {self.std}")
+        device = torch.device("cuda", torch.cuda.current_device())
+        copy_stream = torch.cuda.Stream(device)
+
+        def load():
+            batch = next(iterator, None)
+            if batch is not None:
+                with torch.cuda.stream(copy_stream):
+                    batch = batch.to(device, non_blocking=True)
+            return batch
+
+        next_batch = load()
+        while next_batch is not None:
+            compute_stream = torch.cuda.current_stream(device)
+            compute_stream.wait_stream(copy_stream)
+            # the copies were allocated on the side stream but are used on the compute stream
+            batch = next_batch.apply(lambda t: _record_stream(t, compute_stream))
+            next_batch = load()
+            yield batch
+
+
+class DevicePrefetchLoader(DevicePrefetchMixin, DataLoader):
+    pass
+
+
+class FastDevicePrefetchLoader(DevicePrefetchMixin, FastDataLoader):
+    pass
+
+
+class StreamCursor(Callback):
+    r"""Advances a streamed training set (:class:`torchmdnet.datasets.stream.ShardStream`)
+    through the epochs and stores its shard/offset cursor in the checkpoints, so
+    that training resumes at the stored position of the stream."""
+
+    def __init__(self):
+        self._cursor = None
+
+    def _stream(self, trainer):
+        dataset = getattr(trainer.datamodule, "train_dataset", None)
+        return dataset if isinstance(dataset, ShardStream) else None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        stream = self._stream(trainer)
+        if stream is None:
+            return
+        if self._cursor is not None:
+            stream.load_cursor(self._cursor)
+            self._cursor = None
+        stream.set_epoch(trainer.current_epoch)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx):
+        stream = self._stream(trainer)
+        if stream is not None:
+            stream.record_batch(batch)
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        stream = self._stream(trainer)
+        return stream.cursor() if stream is not None else None
+
+    def on_load_checkpoint(self, callback_state):
+        self._cursor = callback_state
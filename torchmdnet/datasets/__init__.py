@@ -1,10 +1,16 @@
-from .qm9 import QM9
-from .qm9sp import QM9SP
-from .md17 import MD17
-from .ani1 import ANI1
-from .custom import Custom
-from .hdf import HDF5
-from .pcqm4mv2 import PCQM4MV2_XYZ as PCQM4MV2
+import importlib
+
+# datasets are imported on first access, as they pull in heavy dependencies
+# (h5py, ase, torch_geometric.datasets)
+_datasets = {
+    "QM9": (".qm9", "QM9"),
+    "QM9SP": (".qm9sp", "QM9SP"),
+    "MD17": (".md17", "MD17"),
+    "ANI1": (".ani1", "ANI1"),
+    "Custom": (".custom", "Custom"),
+    "HDF5": (".hdf", "HDF5"),
+    "PCQM4MV2": (".pcqm4mv2", "PCQM4MV2_XYZ"),
+}
 
 __all__ = [
     "QM9",
@@ -15,3 +21,16 @@ __all__ = [
     "HDF5",
     "PCQM4MV2"
 ]
+
+
+def __getattr__(name):
+    if name not in _datasets:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module, attr = _datasets[name]
+    dataset = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = dataset
+    return dataset
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
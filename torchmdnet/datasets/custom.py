@@ -1,4 +1,6 @@
+import os
 import glob
+from collections import OrderedDict
 import numpy as np
 import torch
 from torch_geometric.data import Dataset, Data
@@ -17,9 +19,13 @@ class Custom(Dataset):
             (default: :obj:`None`)
         forceglob (string, optional): Glob path for force files.
             (default: :obj:`None`)
+        cache_size (int, optional): Number of opened arrays kept per worker
+            process. (default: :obj:`64`)
     """
 
-    def __init__(self, coordglob, embedglob, energyglob=None, forceglob=None):
+    index_dtype = np.dtype([("file", np.int32), ("row", np.int64)])
+
+    def __init__(self, coordglob, embedglob, energyglob=None, forceglob=None, cache_size=64):
         super(Custom, self).__init__()
         assert energyglob is not None or forceglob is not None, (
             "Either energies, forces or both must " "be specified as the target"
@@ -49,57 +55,154 @@ class Custom(Dataset):
 
         print("Number of files: ", len(self.coordfiles))
 
-        # create index
-        self.index = []
+        # create index, only the .npy headers are read for the consistency checks
         nfiles = len(self.coordfiles)
+        sizes = np.zeros(nfiles, dtype=np.int64)
         for i in range(nfiles):
-            coord_data = np.load(self.coordfiles[i])
-            embed_data = np.load(self.embedfiles[i]).astype(int)
-            size = coord_data.shape[0]
-            self.index.extend(list(zip([i] * size, range(size))))
+            coord_shape = _npy_shape(self.coordfiles[i])
+            embed_shape = _npy_shape(self.embedfiles[i])
+            sizes[i] = coord_shape[0]
 
             # consistency check
-            assert coord_data.shape[1] == embed_data.shape[0], (
-                f"Number of atoms in coordinate file {i} ({coord_data.shape[1]}) "
-                f"does not match number of atoms in embed file {i} ({embed_data.shape[0]})."
+            assert coord_shape[1] == embed_shape[0], (
+                f"Number of atoms in coordinate file {i} ({coord_shape[1]}) "
+                f"does not match number of atoms in embed file {i} ({embed_shape[0]})."
             )
             if self.has_energies:
-                energy_data = np.load(self.energyfiles[i])
-                assert coord_data.shape[0] == energy_data.shape[0], (
-                    f"Number of frames in coordinate file {i} ({coord_data.shape[0]}) "
-                    f"does not match number of frames in energy file {i} ({energy_data.shape[0]})."
+                energy_shape = _npy_shape(self.energyfiles[i])
+                assert coord_shape[0] == energy_shape[0], (
+                    f"Number of frames in coordinate file {i} ({coord_shape[0]}) "
+                    f"does not match number of frames in energy file {i} ({energy_shape[0]})."
                 )
             if self.has_forces:
-                force_data = np.load(self.forcefiles[i])
-                assert coord_data.shape == force_data.shape, (
-                    f"Data shape of coordinate file {i} {coord_data.shape} "
-                    f"does not match the shape of force file {i} {force_data.shape}."
+                force_shape = _npy_shape(self.forcefiles[i])
+                assert coord_shape == force_shape, (
+                    f"Data shape of coordinate file {i} {coord_shape} "
+                    f"does not match the shape of force file {i} {force_shape}."
                 )
+
+        self.sizes = sizes
+        self.index = np.empty(int(sizes.sum()), dtype=self.index_dtype)
+        self.index["file"] = np.repeat(np.arange(nfiles), sizes)
+        self.index["row"] = np.arange(len(self.index)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
         print("Combined dataset size {}".format(len(self.index)))
 
-    def get(self, idx):
-        fileid, index = self.index[idx]
+        self.cache_size = cache_size
+        self._pid = None
+        self._cache = None
+
+    def __getstate__(self):
+        # memory maps are reopened by every worker process
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_cache"] = None
+        return state
+
+    def _array(self, path, embed=False):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._cache = OrderedDict()
+
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            return self._cache[path]
+
+        # embeddings are small and needed as a whole, everything else is memory-mapped
+        array = np.load(path).astype(int) if embed else np.load(path, mmap_mode="r")
+        self._cache[path] = array
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return array
 
-        coord_data = np.array(np.load(self.coordfiles[fileid], mmap_mode="r")[index])
-        embed_data = np.load(self.embedfiles[fileid]).astype(int)
+    def _sample(self, fileid, coord_data, energy_data=None, force_data=None):
+        embed_data = self._array(self.embedfiles[fileid], embed=True)
 
         features = dict(
             pos=torch.from_numpy(coord_data), z=torch.from_numpy(embed_data)
         )
+        if energy_data is not None:
+            features["y"] = torch.from_numpy(np.asarray(energy_data))
+        if force_data is not None:
+            features["dy"] = torch.from_numpy(force_data)
+        return Data(**features)
 
+    def get(self, idx):
+        fileid, index = self.index[idx]
+
+        coord_data = np.array(self._array(self.coordfiles[fileid])[index])
+        energy_data = None
         if self.has_energies:
-            energy_data = np.array(
-                np.load(self.energyfiles[fileid], mmap_mode="r")[index]
-            )
-            features["y"] = torch.from_numpy(energy_data)
+            energy_data = np.array(self._array(self.energyfiles[fileid])[index])
+        force_data = None
+        if self.has_forces:
+            force_data = np.array(self._array(self.forcefiles[fileid])[index])
 
+        return self._sample(fileid, coord_data, energy_data, force_data)
+
+    def get_many(self, idxs):
+        r"""Loads several samples at once, reading all requested frames of a file
+        with a single fancy-indexing operation on the memory-mapped arrays.
+
+        Args:
+            idxs (sequence of int): Dataset indices to load.
+
+        Returns:
+            list of :obj:`torch_geometric.data.Data`, in the order of :obj:`idxs`.
+        """
+        entries = self.index[np.asarray(idxs, dtype=np.int64)]
+        out = [None] * len(entries)
+        for fileid in np.unique(entries["file"]):
+            positions = np.flatnonzero(entries["file"] == fileid)
+            rows, inverse = np.unique(entries["row"][positions], return_inverse=True)
+
+            coord_data = self._array(self.coordfiles[fileid])[rows]
+            energy_data = force_data = None
+            if self.has_energies:
+                energy_data = self._array(self.energyfiles[fileid])[rows]
+            if self.has_forces:
+                force_data = self._array(self.forcefiles[fileid])[rows]
+
+            for k, j in zip(positions, inverse):
+                data = self._sample(
+                    fileid,
+                    coord_data[j],
+                    energy_data[j] if energy_data is not None else None,
+                    force_data[j] if force_data is not None else None,
+                )
+                out[k] = data if self.transform is None else self.transform(data)
+        return out
+
+    def shard_sizes(self):
+        return self.sizes
+
+    def read_shard(self, shard, start, stop):
+        r"""Reads the consecutive frames :obj:`start` to :obj:`stop` of file :obj:`shard`."""
+        coord_data = np.array(self._array(self.coordfiles[shard])[start:stop])
+        energy_data = force_data = None
+        if self.has_energies:
+            energy_data = np.array(self._array(self.energyfiles[shard])[start:stop])
         if self.has_forces:
-            force_data = np.array(
-                np.load(self.forcefiles[fileid], mmap_mode="r")[index]
+            force_data = np.array(self._array(self.forcefiles[shard])[start:stop])
+        return [
+            self._sample(
+                shard,
+                coord_data[j],
+                energy_data[j] if energy_data is not None else None,
+                force_data[j] if force_data is not None else None,
             )
-            features["dy"] = torch.from_numpy(force_data)
-
-        return Data(**features)
+            for j in range(stop - start)
+        ]
 
     def len(self):
         return len(self.index)
+
+
+def _npy_shape(path):
+    # read only the header of a .npy file
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape
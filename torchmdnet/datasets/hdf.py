@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import torch
 from torch_geometric.data import Dataset, Data
 import h5py
@@ -14,46 +16,145 @@ class HDF5(Dataset):
     and "energy" (the energy of each sample).  It may optionally include an array
     called "forces" (the force on each atom).
 
+    The sample index is stored as a compact NumPy array of (file id, group id, row)
+    entries. HDF5 files are opened lazily in the process that reads from them, so
+    every DataLoader worker gets its own file handles.
+
     Args:
         filename (string): A semicolon separated list of HDF5 files.
     """
 
+    index_dtype = np.dtype([("file", np.int32), ("group", np.int32), ("row", np.int64)])
+
     def __init__(self, filename, **kwargs):
         super(HDF5, self).__init__()
-        files = [h5py.File(f, "r") for f in filename.split(";")]
-        self.index = []
-        self.has_forces = False
-        for file in files:
-            for group_name in file:
-                group = file[group_name]
-                types = group["types"]
-                pos = group["pos"]
-                energy = group["energy"]
-                if "forces" in group:
-                    self.has_forces = True
-                    forces = group["forces"]
-                    for i in range(len(energy)):
-                        self.index.append((types, pos, energy, forces, i))
-                else:
-                    for i in range(len(energy)):
-                        self.index.append((types, pos, energy, i))
+        self.filenames = filename.split(";")
+        # one (file id, group name) entry per group, addressed by the group id
+        self.groups = []
+        self.group_has_forces = []
+        group_sizes = []
+        for file_id, path in enumerate(self.filenames):
+            with h5py.File(path, "r") as file:
+                for group_name in file:
+                    group = file[group_name]
+                    self.groups.append((file_id, group_name))
+                    self.group_has_forces.append("forces" in group)
+                    group_sizes.append(len(group["energy"]))
+        self.has_forces = any(self.group_has_forces)
+
+        group_sizes = np.array(group_sizes, dtype=np.int64)
+        self.group_sizes = group_sizes
+        self.index = np.empty(int(group_sizes.sum()), dtype=self.index_dtype)
+        group_ids = np.repeat(np.arange(len(self.groups)), group_sizes)
+        group_starts = np.cumsum(group_sizes) - group_sizes
+        self.index["file"] = np.array([f for f, _ in self.groups], dtype=np.int32)[group_ids]
+        self.index["group"] = group_ids
+        self.index["row"] = np.arange(len(self.index)) - group_starts[group_ids]
+
+        self._pid = None
+        self._files = None
+        self._datasets = None
+
+    def __getstate__(self):
+        # h5py handles can not be shared between processes, workers reopen the files
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_files"] = None
+        state["_datasets"] = None
+        return state
+
+    def _group(self, group_id):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._files = [None] * len(self.filenames)
+            self._datasets = dict()
+
+        if group_id not in self._datasets:
+            file_id, group_name = self.groups[group_id]
+            if self._files[file_id] is None:
+                self._files[file_id] = h5py.File(self.filenames[file_id], "r")
+            group = self._files[file_id][group_name]
+            forces = group["forces"] if self.group_has_forces[group_id] else None
+            self._datasets[group_id] = (group["types"], group["pos"], group["energy"], forces)
+        return self._datasets[group_id]
+
+    def _sample(self, types, pos, energy, forces):
+        data = Data(
+            pos=torch.from_numpy(pos),
+            z=torch.from_numpy(types).to(torch.long),
+            y=torch.tensor([[energy]]),
+        )
+        if forces is not None:
+            data.dy = torch.from_numpy(forces)
+        return data
 
     def get(self, idx):
-        if self.has_forces:
-            types, pos, energy, forces, i = self.index[idx]
-            return Data(
-                pos=torch.from_numpy(pos[i]),
-                z=torch.from_numpy(types[i]).to(torch.long),
-                y=torch.tensor([[energy[i]]]),
-                dy=torch.from_numpy(forces[i]),
-            )
-        else:
-            types, pos, energy, i = self.index[idx]
-            return Data(
-                pos=torch.from_numpy(pos[i]),
-                z=torch.from_numpy(types[i]).to(torch.long),
-                y=torch.tensor([[energy[i]]]),
-            )
+        _, group_id, i = self.index[idx]
+        types, pos, energy, forces = self._group(group_id)
+        return self._sample(
+            types[i], pos[i], energy[i], forces[i] if forces is not None else None
+        )
+
+    def get_many(self, idxs):
+        r"""Loads several samples at once. Requested rows are sorted per group and
+        contiguous runs of rows are read with a single slice each.
+
+        Args:
+            idxs (sequence of int): Dataset indices to load.
+
+        Returns:
+            list of :obj:`torch_geometric.data.Data`, in the order of :obj:`idxs`.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        entries = self.index[idxs]
+        order = np.lexsort((entries["row"], entries["group"]))
+        out = [None] * len(idxs)
+
+        start = 0
+        while start < len(order):
+            group_id = entries["group"][order[start]]
+            stop = start
+            while stop < len(order) and entries["group"][order[stop]] == group_id:
+                stop += 1
+            group_order = order[start:stop]
+            rows = entries["row"][group_order]
+            types, pos, energy, forces = self._group(group_id)
+
+            # split the sorted rows into contiguous runs (duplicates are read once)
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            breaks = np.flatnonzero(np.diff(unique_rows) != 1) + 1
+            run_starts = np.concatenate([[0], breaks])
+            run_stops = np.concatenate([breaks, [len(unique_rows)]])
+            for run_start, run_stop in zip(run_starts, run_stops):
+                first, last = unique_rows[run_start], unique_rows[run_stop - 1] + 1
+                run_types, run_pos, run_energy = types[first:last], pos[first:last], energy[first:last]
+                run_forces = forces[first:last] if forces is not None else None
+                # rows are sorted, so the requests served by this run are contiguous
+                k_start, k_stop = np.searchsorted(inverse, [run_start, run_stop])
+                for k in range(k_start, k_stop):
+                    j = unique_rows[inverse[k]] - first
+                    data = self._sample(
+                        run_types[j],
+                        run_pos[j],
+                        run_energy[j],
+                        run_forces[j] if run_forces is not None else None,
+                    )
+                    out[group_order[k]] = data if self.transform is None else self.transform(data)
+            start = stop
+        return out
+
+    def shard_sizes(self):
+        return self.group_sizes
+
+    def read_shard(self, shard, start, stop):
+        r"""Reads the consecutive rows :obj:`start` to :obj:`stop` of group :obj:`shard`."""
+        types, pos, energy, forces = self._group(shard)
+        types, pos, energy = types[start:stop], pos[start:stop], energy[start:stop]
+        forces = forces[start:stop] if forces is not None else None
+        return [
+            self._sample(types[j], pos[j], energy[j], forces[j] if forces is not None else None)
+            for j in range(stop - start)
+        ]
 
     def len(self):
         return len(self.index)
@@ -0,0 +1,236 @@
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from pytorch_lightning.utilities import rank_zero_warn
+
+
+class ShardStream(IterableDataset):
+    r"""Streams samples of a sharded dataset sequentially instead of indexing them.
+
+    The wrapped dataset has to implement ``shard_sizes()``, returning the number of
+    samples in every shard, and ``read_shard(shard, start, stop)``, returning the
+    consecutive samples ``start`` to ``stop`` of a shard (see
+    :class:`torchmdnet.datasets.Custom` and :class:`torchmdnet.datasets.HDF5`).
+    Samples are numbered by concatenating all shards, only the range
+    :obj:`start` to :obj:`stop` of this numbering is streamed.
+
+    Every epoch the shards are put in a random order, the resulting sample stream is
+    cut into equally sized pieces, one per DataLoader worker on every DDP rank, and
+    each worker shuffles its piece in consecutive blocks of :obj:`buffer_size`
+    samples. All of this only depends on :obj:`seed` and the epoch, which allows
+    resuming an epoch from the shard/offset cursor returned by :meth:`cursor`.
+    Every sample carries the local worker that yielded it (:obj:`stream_worker`)
+    and the number of samples that worker yielded so far (:obj:`stream_offset`),
+    from which :meth:`record_batch` tracks the consumed part of the stream.
+
+    Args:
+        dataset: The sharded dataset to stream.
+        start (int, optional): First sample to stream. (default: :obj:`0`)
+        stop (int, optional): End of the streamed sample range. Streams until the end
+            of the dataset if :obj:`None`. (default: :obj:`None`)
+        buffer_size (int, optional): Number of samples read and shuffled at once.
+            (default: :obj:`10000`)
+        shuffle (bool, optional): Whether to shuffle shards and samples.
+            (default: :obj:`True`)
+        seed (int, optional): Random seed of the shuffling. (default: :obj:`0`)
+        transform (callable, optional): Transform applied to every sample.
+            (default: :obj:`None`)
+    """
+
+    def __init__(
+        self,
+        dataset,
+        start=0,
+        stop=None,
+        buffer_size=10000,
+        shuffle=True,
+        seed=0,
+        transform=None,
+    ):
+        super(ShardStream, self).__init__()
+        self.dataset = dataset
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.transform = transform
+
+        # clip the shards to the streamed sample range
+        sizes = np.asarray(dataset.shard_sizes(), dtype=np.int64)
+        offsets = np.cumsum(sizes) - sizes
+        stop = int(sizes.sum()) if stop is None else stop
+        self.segments = []
+        for shard, (offset, size) in enumerate(zip(offsets, sizes)):
+            lo, hi = max(start - offset, 0), min(stop - offset, size)
+            if lo < hi:
+                self.segments.append((shard, int(lo), int(hi)))
+        self.num_samples = sum(hi - lo for _, lo, hi in self.segments)
+
+        self.epoch = 0
+        self.rank, self.world_size = 0, 1
+        self.num_workers = 1
+        self.batch_size = 1
+        self._positions = torch.zeros(1, dtype=torch.long)
+        self._resume = None
+        self._resume_epoch = None
+        self._resume_rank = 0
+
+    def set_epoch(self, epoch):
+        r"""Starts a new epoch, or the resumed one if a cursor for it was loaded."""
+        self.epoch = epoch
+        self._positions = torch.zeros(self.num_workers, dtype=torch.long)
+        if self._resume is not None and self._resume_epoch == epoch:
+            self._positions = torch.tensor(
+                [
+                    self._resume_position(worker, state)
+                    for worker, state in enumerate(self._resume[: self.num_workers])
+                ],
+                dtype=torch.long,
+            )
+
+    def set_distributed(self, rank, world_size, num_workers, batch_size):
+        r"""Registers how the stream is consumed. Has to be called in the main process
+        before the DataLoader is iterated."""
+        self.rank, self.world_size = rank, world_size
+        self.num_workers = max(num_workers, 1)
+        self.batch_size = batch_size
+        self._positions = torch.zeros(self.num_workers, dtype=torch.long)
+
+    def record_batch(self, batch):
+        r"""Registers that the main process consumed :obj:`batch`. The samples of a
+        batch come from a single worker, its position is taken from the last sample.
+        The positions stay on the device of the batch and are only read by
+        :meth:`cursor`, so recording does not synchronize with the host."""
+        if self._positions.device != batch.stream_offset.device:
+            self._positions = self._positions.to(batch.stream_offset.device)
+        self._positions[batch.stream_worker[-1:]] = batch.stream_offset[-1:]
+
+    @property
+    def samples_per_worker(self):
+        return self.num_samples // (self.world_size * self.num_workers)
+
+    def __len__(self):
+        # every worker ends with a partial batch, the DataLoader divides the length by
+        # the batch size, so a multiple of it is returned to get the number of batches
+        batches_per_worker = -(-self.samples_per_worker // self.batch_size)
+        return batches_per_worker * self.num_workers * self.batch_size
+
+    def _worker_pieces(self, worker):
+        # (shard, lo, hi, stream position) pieces of a worker's part of the epoch
+        order = np.arange(len(self.segments))
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, self.epoch)).permutation(order)
+        n = self.samples_per_worker
+        begin, end = worker * n, (worker + 1) * n
+
+        pieces, position = [], 0
+        for i in order:
+            shard, lo, hi = self.segments[i]
+            seg_begin, seg_end = position, position + hi - lo
+            position = seg_end
+            if seg_end <= begin or seg_begin >= end:
+                continue
+            first, last = max(seg_begin, begin), min(seg_end, end)
+            pieces.append((shard, lo + first - seg_begin, lo + last - seg_begin, first - begin))
+        return pieces
+
+    def _read(self, pieces, begin, end):
+        samples = []
+        for shard, lo, hi, position in pieces:
+            first, last = max(begin, position), min(end, position + hi - lo)
+            if first < last:
+                samples.extend(
+                    self.dataset.read_shard(shard, lo + first - position, lo + last - position)
+                )
+        return samples
+
+    def cursor(self):
+        r"""Returns the position of every worker in the current epoch.
+
+        Every position is given as the shard and offset at which the worker's current
+        shuffle block starts, plus the number of samples of that block which were
+        already yielded. Finished workers have shard :obj:`-1`. All ranks consume
+        the same number of samples per worker, so the positions of the local workers
+        are valid on every rank.
+        """
+        workers = []
+        for worker, position in enumerate(self._positions.tolist()):
+            block_start = position - position % self.buffer_size
+            shard, offset = -1, 0
+            for piece_shard, lo, hi, piece_position in self._worker_pieces(
+                self.rank * self.num_workers + worker
+            ):
+                if piece_position <= block_start < piece_position + hi - lo:
+                    shard, offset = piece_shard, lo + block_start - piece_position
+                    break
+            workers.append(dict(shard=shard, offset=offset, skip=position - block_start))
+        return dict(
+            epoch=self.epoch,
+            rank=self.rank,
+            world_size=self.world_size,
+            num_workers=self.num_workers,
+            workers=workers,
+        )
+
+    def _resume_position(self, worker, state):
+        # map a stored shard/offset position of a local worker back to a stream position
+        if state["shard"] < 0:
+            return self.samples_per_worker
+        # positions are stored for the workers of the saving rank
+        pieces = self._worker_pieces(self._resume_rank * self.num_workers + worker)
+        for shard, lo, hi, piece_position in pieces:
+            if shard == state["shard"] and lo <= state["offset"] < hi:
+                return piece_position + state["offset"] - lo + state["skip"]
+        return self.samples_per_worker
+
+    def load_cursor(self, cursor):
+        r"""Resumes the epoch stored in :obj:`cursor` at the stored position."""
+        if (
+            cursor["world_size"] != self.world_size
+            or cursor["num_workers"] != self.num_workers
+        ):
+            rank_zero_warn(
+                "The number of ranks or data loader workers changed, "
+                "the streamed epoch is restarted from the beginning."
+            )
+            return
+        self._resume = cursor["workers"]
+        self._resume_epoch = cursor["epoch"]
+        self._resume_rank = cursor["rank"]
+        self.set_epoch(cursor["epoch"])
+
+    def __getstate__(self):
+        # the consumed positions are only tracked in the main process and may be on the GPU
+        state = self.__dict__.copy()
+        state["_positions"] = None
+        return state
+
+    def __iter__(self):
+        info = get_worker_info()
+        local_worker = 0 if info is None else info.id
+        worker = self.rank * self.num_workers + local_worker
+        pieces = self._worker_pieces(worker)
+        n = self.samples_per_worker
+
+        position = 0
+        if self._resume is not None and self._resume_epoch == self.epoch:
+            # all ranks resume at the positions of the local workers of the saving rank
+            position = self._resume_position(local_worker, self._resume[local_worker])
+
+        block = position // self.buffer_size
+        skip = position % self.buffer_size
+        while block * self.buffer_size < n:
+            begin = block * self.buffer_size
+            samples = self._read(pieces, begin, min(begin + self.buffer_size, n))
+            order = np.arange(len(samples))
+            if self.shuffle:
+                rng = np.random.default_rng((self.seed, self.epoch, worker, block))
+                order = rng.permutation(order)
+            for i in order[skip:]:
+                data = samples[i]
+                data = data if self.transform is None else self.transform(data)
+                position += 1
+                data.stream_worker = local_worker
+                data.stream_offset = position
+                yield data
+            block += 1
+            skip = 0
@@ -0,0 +1,126 @@
+import json
+import os
+from os.path import join, exists
+import numpy as np
+
+
+class EmbeddingWriter(object):
+    r"""Writes embeddings to a sharded store of memory-mapped float16 arrays.
+
+    Every shard holds :obj:`shard_size` rows of each embedding and the dataset index of
+    the molecule of each row. The number of valid rows per shard is recorded in
+    :obj:`meta.json` when the writer is closed, a store without it is incomplete.
+
+    Args:
+        root (str): Directory of the store.
+        dims (dict): Width of every embedding, e.g. :obj:`{"molecule": 256, "spectra": 256}`.
+        shard_size (int, optional): Number of rows per shard. (default: :obj:`100000`)
+        meta (dict, optional): Additional information saved in :obj:`meta.json`.
+            (default: :obj:`None`)
+    """
+
+    def __init__(self, root, dims, shard_size=100000, meta=None):
+        os.makedirs(root, exist_ok=True)
+        assert not exists(join(root, "meta.json")), f"An embedding store already exists in {root}."
+        self.root = root
+        self.dims = dict(dims)
+        self.shard_size = shard_size
+        self.meta = dict() if meta is None else meta
+        self.counts = []
+        self.arrays = None
+
+    def _open_shard(self):
+        shard = len(self.counts)
+        self.arrays = {
+            name: np.lib.format.open_memmap(
+                join(self.root, f"{name}-{shard:05d}.npy"), mode="w+", dtype=np.float16, shape=(self.shard_size, dim)
+            )
+            for name, dim in self.dims.items()
+        }
+        self.arrays["index"] = np.lib.format.open_memmap(
+            join(self.root, f"index-{shard:05d}.npy"), mode="w+", dtype=np.int64, shape=(self.shard_size,)
+        )
+        self.counts.append(0)
+
+    def _flush(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = None
+
+    def write(self, index, **embeddings):
+        r"""Appends a batch of embeddings.
+
+        Args:
+            index (array): Dataset index of every molecule in the batch.
+            **embeddings (array): One array of shape :obj:`[len(index), dim]` per embedding.
+        """
+        assert set(embeddings) == set(self.dims), f"Expected the embeddings {sorted(self.dims)}."
+        index = np.asarray(index, dtype=np.int64)
+        embeddings = {name: np.asarray(value, dtype=np.float16) for name, value in embeddings.items()}
+        start = 0
+        while start < len(index):
+            if self.arrays is None:
+                self._open_shard()
+            offset = self.counts[-1]
+            stop = min(len(index), start + self.shard_size - offset)
+            self.arrays["index"][offset : offset + stop - start] = index[start:stop]
+            for name, value in embeddings.items():
+                self.arrays[name][offset : offset + stop - start] = value[start:stop]
+            self.counts[-1] += stop - start
+            start = stop
+            if self.counts[-1] == self.shard_size:
+                self._flush()
+
+    def close(self):
+        if self.arrays is not None:
+            self._flush()
+        meta = dict(self.meta, dims=self.dims, shard_size=self.shard_size, counts=self.counts)
+        with open(join(self.root, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        elif self.arrays is not None:
+            # keep the rows written so far, but leave the store incomplete
+            self._flush()
+
+
+class EmbeddingStore(object):
+    r"""Reads a store written by :class:`EmbeddingWriter`. Shards are memory-mapped,
+    only the accessed rows are read from disk.
+
+    Args:
+        root (str): Directory of the store.
+    """
+
+    def __init__(self, root):
+        with open(join(root, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.root = root
+        self.dims = self.meta["dims"]
+        self.counts = self.meta["counts"]
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def shards(self, name):
+        r"""Returns the memory-mapped shards of the embedding :obj:`name`, or of the
+        molecule indices if :obj:`name` is :obj:`"index"`."""
+        assert name == "index" or name in self.dims, f"Unknown embedding {name}."
+        return [
+            np.load(join(self.root, f"{name}-{shard:05d}.npy"), mmap_mode="r")[:count]
+            for shard, count in enumerate(self.counts)
+        ]
+
+    def index(self):
+        return np.concatenate(self.shards("index")) if len(self.counts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def load(self, name):
+        r"""Loads the embedding :obj:`name` of all molecules into memory."""
+        if len(self.counts) == 0:
+            return np.zeros((0, self.dims[name]), dtype=np.float16)
+        return np.concatenate(self.shards(name))
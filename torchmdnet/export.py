@@ -0,0 +1,147 @@
+import copy
+from typing import Optional, List, Tuple
+import torch
+from torch import nn
+from torch.autograd import grad
+from torchmdnet.models.model import load_model, aggregate
+from torchmdnet.models.output_modules import Scalar, EquivariantScalar
+
+
+class InferenceModel(nn.Module):
+    r"""Slim inference version of a :class:`TorchMD_Net`, containing only the
+    representation model, the target output model and the prior model. The training
+    only parts (noise, spectra and molecule feature heads, spectra model and position
+    normalizer) are dropped and the data standard deviation is folded into the last
+    layer of the output model where possible.
+
+    The forward pass returns the prediction and, if :obj:`derivative` is set, the
+    negative gradient with respect to the positions, otherwise :obj:`None`.
+
+    Args:
+        model (TorchMD_Net): The trained model, it is not modified.
+    """
+
+    def __init__(self, model):
+        super(InferenceModel, self).__init__()
+        self.representation_model = copy.deepcopy(model.representation_model)
+        self.output_model = copy.deepcopy(model.output_model)
+        self.prior_model = copy.deepcopy(model.prior_model)
+        self.reduce_op = model.reduce_op
+        self.atom_filter = model.atom_filter
+        self.derivative = model.derivative
+
+        std = model.std.detach().clone()
+        if _fold_std(self.output_model, std):
+            std = torch.ones_like(std)
+        self.register_buffer("std", std)
+        self.register_buffer("mean", model.mean.detach().clone())
+
+    def forward(
+        self, z, pos, batch: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        batch = torch.zeros_like(z) if batch is None else batch
+
+        if self.derivative:
+            pos.requires_grad_(True)
+
+        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
+        x = self.output_model.pre_reduce(x, v, z, pos, batch)
+
+        if self.prior_model is not None:
+            x = self.prior_model.scale_and_apply(x, self.std, z, pos, batch)
+        else:
+            x = x * self.std
+
+        out = aggregate(x, z, batch, self.reduce_op, self.atom_filter)
+        out = out + self.mean
+        out = self.output_model.post_reduce(out)
+
+        if self.derivative:
+            grad_outputs: List[Optional[torch.Tensor]] = [torch.ones_like(out)]
+            dy = grad([out], [pos], grad_outputs=grad_outputs)[0]
+            if dy is None:
+                raise RuntimeError("Autograd returned None for the force prediction.")
+            return out, -dy
+        return out, None
+
+
+def _fold_std(output_model, std):
+    # scales the output layer of linear output heads by the standard deviation
+    if std.numel() != 1:
+        return False
+    if type(output_model) is Scalar:
+        layer, rows = output_model.output_network[2], slice(None)
+    elif type(output_model) is EquivariantScalar:
+        # the scalar outputs of the last gated block are the first out_channels rows
+        block = output_model.output_network[-1]
+        if block.act is not None:
+            return False
+        layer, rows = block.update_net[2], slice(0, block.out_channels)
+    else:
+        return False
+    with torch.no_grad():
+        layer.weight[rows] *= std.reshape(())
+        layer.bias[rows] *= std.reshape(())
+    return True
+
+
+def _example_inputs(device):
+    # a small molecule, only used to check the exported model
+    z = torch.tensor([6, 1, 1, 1, 1], dtype=torch.long, device=device)
+    pos = torch.tensor(
+        [[0.0, 0.0, 0.0], [0.63, 0.63, 0.63], [-0.63, -0.63, 0.63], [-0.63, 0.63, -0.63], [0.63, -0.63, -0.63]],
+        device=device,
+    )
+    return z, pos, torch.zeros_like(z)
+
+
+def check_export(model, output_path, device="cpu", rtol=1e-4, atol=1e-5):
+    r"""Loads an exported model and compares its energy and forces on a small molecule
+    with :meth:`TorchMD_Net.predict` of the original model. Raises a
+    :obj:`RuntimeError` if they differ.
+
+    Args:
+        model (TorchMD_Net): The model the export was created from.
+        output_path (str): Path of the exported model.
+        device (str, optional): Device to compare on. (default: :obj:`"cpu"`)
+        rtol (float, optional): Relative tolerance. (default: :obj:`1e-4`)
+        atol (float, optional): Absolute tolerance. (default: :obj:`1e-5`)
+    """
+    exported = torch.jit.load(output_path, map_location=device)
+    z, pos, batch = _example_inputs(device)
+
+    pos_ref = pos.clone().requires_grad_(model.derivative)
+    y_ref = model.predict(z, pos_ref, batch)
+    y, forces = exported(z, pos.clone(), batch)
+    if not torch.allclose(y, y_ref, rtol=rtol, atol=atol):
+        raise RuntimeError(f"The exported model predicts {y.tolist()} instead of {y_ref.tolist()}.")
+
+    if model.derivative:
+        forces_ref = -grad([y_ref.sum()], [pos_ref])[0]
+        if forces is None or not torch.allclose(forces, forces_ref, rtol=rtol, atol=atol):
+            raise RuntimeError("The forces of the exported model differ from the original model.")
+
+
+def export_model(filepath, output_path, device="cpu", check=True, **kwargs):
+    r"""Exports a checkpoint as a slim :class:`InferenceModel`, saved as a TorchScript
+    module which is loaded with :func:`torch.jit.load`.
+
+    :func:`torch.export.export` is not supported, the neighbor search of
+    :obj:`torch_cluster.radius_graph` is not traceable, the number of edges depends on
+    the positions and the forces need :func:`torch.autograd.grad`.
+
+    Args:
+        filepath (str): Path to the training checkpoint.
+        output_path (str): Path of the exported model.
+        device (str, optional): Device of the exported model. (default: :obj:`"cpu"`)
+        check (bool, optional): Reload the saved model and compare it with the
+            checkpoint, see :func:`check_export`. (default: :obj:`True`)
+        **kwargs: Hyperparameters overriding the ones of the checkpoint, e.g.
+            :obj:`derivative=True`.
+    """
+    model = load_model(filepath, device=device, **kwargs).eval()
+    inference_model = InferenceModel(model).eval()
+    torch.jit.save(torch.jit.script(inference_model), output_path)
+    if check:
+        check_export(model, output_path, device=device)
+    return inference_model
@@ -0,0 +1,86 @@
+import torch
+from torch.autograd import grad
+from torchmdnet.models.model import load_model
+
+
+class InferenceEngine(object):
+    r"""Predicts energies and forces of many molecules of different sizes.
+
+    Molecules are packed into batches of at most :obj:`atom_budget` atoms. Only the
+    representation model and the target output model are evaluated
+    (:meth:`TorchMD_Net.predict`), spectra, noise and molecule feature heads are
+    skipped. Energies are computed under :func:`torch.inference_mode`, forces with
+    a first order gradient that does not build a graph for backpropagation.
+
+    Args:
+        model (TorchMD_Net or str): The model or the path to a checkpoint.
+        atom_budget (int, optional): Maximum number of atoms per batch. Molecules with
+            more atoms are evaluated alone. (default: :obj:`4096`)
+        device (str, optional): Device to run the model on. (default: :obj:`"cpu"`)
+        forces (bool, optional): Whether to compute forces. Defaults to the model's
+            :obj:`derivative` setting. (default: :obj:`None`)
+    """
+
+    def __init__(self, model, atom_budget=4096, device="cpu", forces=None):
+        if isinstance(model, str):
+            model = load_model(model, device=device)
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.atom_budget = atom_budget
+        self.forces = model.derivative if forces is None else forces
+
+    def pack(self, sizes):
+        r"""Splits molecules with :obj:`sizes` atoms into consecutive batches of at most
+        :obj:`atom_budget` atoms. Returns (start, stop) molecule ranges."""
+        ranges, start, num_atoms = [], 0, 0
+        for i, size in enumerate(sizes):
+            if num_atoms + size > self.atom_budget and i > start:
+                ranges.append((start, i))
+                start, num_atoms = i, 0
+            num_atoms += size
+        if start < len(sizes):
+            ranges.append((start, len(sizes)))
+        return ranges
+
+    def predict_batch(self, z, pos, batch):
+        r"""Predicts the energies of a batch of molecules and, if enabled, the forces
+        on their atoms."""
+        z, pos, batch = z.to(self.device), pos.to(self.device, torch.float32), batch.to(self.device)
+        if not self.forces:
+            with torch.inference_mode():
+                return self.model.predict(z, pos, batch), None
+
+        with torch.enable_grad():
+            pos = pos.detach().requires_grad_(True)
+            energy = self.model.predict(z, pos, batch)
+            dy = grad([energy.sum()], [pos], create_graph=False)[0]
+        return energy.detach(), -dy
+
+    def __call__(self, zs, positions):
+        r"""Predicts energies and forces of a list of molecules.
+
+        Args:
+            zs (list of Tensor): Atomic numbers of every molecule.
+            positions (list of Tensor): Atom positions of every molecule.
+
+        Returns:
+            The energies of all molecules as a tensor with one row per molecule and
+            a list of per molecule force tensors, or :obj:`None` if forces are disabled.
+        """
+        assert len(zs) == len(positions), "Every molecule needs atomic numbers and positions."
+        zs = [torch.as_tensor(z, dtype=torch.long) for z in zs]
+        positions = [torch.as_tensor(pos, dtype=torch.float32) for pos in positions]
+        sizes = [len(z) for z in zs]
+
+        energies, forces = [], []
+        for start, stop in self.pack(sizes):
+            counts = torch.tensor(sizes[start:stop])
+            batch = torch.repeat_interleave(torch.arange(stop - start), counts)
+            energy, dy = self.predict_batch(
+                torch.cat(zs[start:stop]), torch.cat(positions[start:stop]), batch
+            )
+            energies.append(energy.cpu())
+            if dy is not None:
+                forces.extend(torch.split(dy.cpu(), sizes[start:stop]))
+        energies = torch.cat(energies) if len(energies) > 0 else torch.zeros(0, 1)
+        return energies, forces if self.forces else None
@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+from os.path import join, exists
+import numpy as np
+from pytorch_lightning.core.saving import save_hparams_to_yaml
+from pytorch_lightning.loggers import LightningLoggerBase
+from pytorch_lightning.loggers.base import rank_zero_experiment
+from pytorch_lightning.utilities import rank_zero_only
+
+
+RECORD_DTYPE = np.dtype([("step", "<i8"), ("key", "<i4"), ("value", "<f8")])
+
+
+class _MetricsWriter(threading.Thread):
+    # appends batches of records to the metrics file, off the training thread
+    def __init__(self, path, keys_path):
+        super(_MetricsWriter, self).__init__(daemon=True)
+        self.path = path
+        self.keys_path = keys_path
+        self.queue = queue.Queue()
+        self.error = None
+
+    def run(self):
+        with open(self.path, "ab") as f, open(self.keys_path, "a") as keys_file:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    self.queue.task_done()
+                    break
+                try:
+                    new_keys, records = item
+                    for key in new_keys:
+                        keys_file.write(key + "\n")
+                    keys_file.flush()
+                    f.write(np.array(records, dtype=RECORD_DTYPE).tobytes())
+                    f.flush()
+                except Exception as e:
+                    self.error = e
+                self.queue.task_done()
+
+
+class LocalLogger(LightningLoggerBase):
+    r"""Logger for machines without network access, which writes the metrics to a
+    compact binary file in :obj:`save_dir`.
+
+    Every metric value is one record of :obj:`(step, key, value)`
+    (see :obj:`RECORD_DTYPE`) in :obj:`metrics.bin`, the metric names are listed in
+    :obj:`metrics-keys.txt` in the order of their key. Records are buffered and
+    written by a background thread, so logging does not wait for the file system.
+    The metrics are read with :func:`read_metrics` and can be converted to
+    TensorBoard with ``scripts/metrics_to_tensorboard.py``.
+
+    Args:
+        save_dir (str): Output directory.
+        flush_size (int, optional): Number of buffered records that are handed to
+            the writer thread at once. (default: :obj:`1024`)
+    """
+
+    def __init__(self, save_dir, flush_size=1024):
+        super(LocalLogger, self).__init__()
+        self._save_dir = save_dir
+        self.flush_size = flush_size
+        self.keys = dict()
+        self._new_keys = []
+        self._records = []
+        self._writer = None
+
+    @property
+    def name(self):
+        return "local"
+
+    @property
+    def version(self):
+        return ""
+
+    @property
+    def save_dir(self):
+        return self._save_dir
+
+    @property
+    @rank_zero_experiment
+    def experiment(self):
+        if self._writer is None:
+            os.makedirs(self._save_dir, exist_ok=True)
+            keys_path = join(self._save_dir, "metrics-keys.txt")
+            if exists(keys_path):
+                # continue a resumed run
+                with open(keys_path, "r") as f:
+                    self.keys = {key: i for i, key in enumerate(f.read().splitlines())}
+            self._writer = _MetricsWriter(join(self._save_dir, "metrics.bin"), keys_path)
+            self._writer.start()
+        return self._writer
+
+    @rank_zero_only
+    def log_hyperparams(self, params):
+        params = self._convert_params(params)
+        os.makedirs(self._save_dir, exist_ok=True)
+        save_hparams_to_yaml(join(self._save_dir, "hparams.yaml"), params)
+
+    @rank_zero_only
+    def log_metrics(self, metrics, step=None):
+        writer = self.experiment
+        step = -1 if step is None else int(step)
+        for key, value in metrics.items():
+            if key not in self.keys:
+                self.keys[key] = len(self.keys)
+                self._new_keys.append(key)
+            self._records.append((step, self.keys[key], float(value)))
+        if len(self._records) >= self.flush_size:
+            self._hand_over(writer)
+
+    def _hand_over(self, writer):
+        if writer.error is not None:
+            raise writer.error
+        writer.queue.put((self._new_keys, self._records))
+        self._new_keys, self._records = [], []
+
+    @rank_zero_only
+    def save(self):
+        super(LocalLogger, self).save()
+        if self._writer is not None and len(self._records) > 0:
+            self._hand_over(self._writer)
+
+    @rank_zero_only
+    def finalize(self, status):
+        if self._writer is None:
+            return
+        self.save()
+        self._writer.queue.put(None)
+        self._writer.join()
+        self._writer = None
+
+
+def read_metrics(save_dir):
+    r"""Reads the metrics written by :class:`LocalLogger`. Returns a dict mapping every
+    metric name to an array of steps and an array of values."""
+    with open(join(save_dir, "metrics-keys.txt"), "r") as f:
+        keys = f.read().splitlines()
+    records = np.fromfile(join(save_dir, "metrics.bin"), dtype=RECORD_DTYPE)
+    # sorted by key, the steps of a key stay in logging order
+    order = np.argsort(records["key"], kind="stable")
+    records = records[order]
+    bounds = np.searchsorted(records["key"], np.arange(len(keys) + 1))
+    return {
+        key: (records["step"][start:stop], records["value"][start:stop])
+        for key, start, stop in zip(keys, bounds[:-1], bounds[1:])
+    }
@@ -8,6 +8,7 @@ import sys
 
 sys.path.append(sys.path[0] + "/..")
 from torchmdnet.models.CBAM import CBAMBlock
+from torchmdnet.profiling import stage
 from torchmdnet.models.SpecFormer_layers import *
 
 
@@ -229,51 +230,68 @@ class SpecFormer(nn.Module):
 
         self.out_norm.reset_parameters()
 
+    def patch(self, i, spec):
+        # normalize the i-th spectrum and cut it into patches
+        if self.input_norm_type == 'minmax':
+            spec = (spec - self.spectra_min_vals[i] + self.norm_eps) / (self.spectra_max_vals[i] - self.spectra_min_vals[i] + self.norm_eps)
+        elif self.input_norm_type == 'log10':
+            spec = torch.log10(spec + 1)
+        elif self.input_norm_type == 'log':
+            spec = torch.log(spec + 1)
+
+        return spec.unfold(dimension=-1, size=self.patch_len[i], step=self.stride[i])
+
+    def encode(self, spectra):
+        """
+        Representation of unmasked spectra, without the reconstruction task. Used for inference.
+        """
+        patched_spectra = [self.patch(i, spec).permute(0,2,1) for i, spec in enumerate(spectra)]
+        z = self.backbone(patched_spectra)
+        z = self.head(z)
+        return self.out_norm(z)
+
     def forward(self, spectra):  # spectra is a list
 
         # uv, ir, raman = x[0], x[1], x[2]
 
         # patching
-        patched_spectra = []
-        patched_spectra_masked = []
-        masks = []
-        for i, spec in enumerate(spectra):
-
-            if self.input_norm_type == 'minmax':
-                spec = (spec - self.spectra_min_vals[i] + self.norm_eps) / (self.spectra_max_vals[i] - self.spectra_min_vals[i] + self.norm_eps)
-            elif self.input_norm_type == 'log10':
-                spec = torch.log10(spec + 1)
-            elif self.input_norm_type == 'log':
-                spec = torch.log(spec + 1)
+        with stage("specformer_patching"):
+            patched_spectra = []
+            patched_spectra_masked = []
+            masks = []
+            for i, spec in enumerate(spectra):
 
-            spec = spec.unfold(dimension=-1, size=self.patch_len[i], step=self.stride[i])
+                spec = self.patch(i, spec)
 
-            spec_masked, _, mask, _ = random_masking(spec, self.mask_ratios[i])
+                spec_masked, _, mask, _ = random_masking(spec, self.mask_ratios[i])
 
-            masks.append(mask)
+                masks.append(mask)
 
-            spec = spec.permute(0,2,1)   
-            patched_spectra.append(spec)  
+                spec = spec.permute(0,2,1)   
+                patched_spectra.append(spec)  
 
-            spec_masked = spec_masked.permute(0,2,1)   
-            patched_spectra_masked.append(spec_masked)  
+                spec_masked = spec_masked.permute(0,2,1)   
+                patched_spectra_masked.append(spec_masked)  
 
         # model
-        z = self.backbone(patched_spectra_masked)          # list -> z: [bs x patch_num x d_model]
+        with stage("specformer_backbone"):
+            z = self.backbone(patched_spectra_masked)          # list -> z: [bs x patch_num x d_model]
 
         # reconstruct
-        z_reconstruct = z.clone()
-        loss_reconstruct = 0
-        start_idx = 0
-        for i in range(len(spectra)):
-            cur_reconstructed_patch = self.reconstruct_heads[i](z_reconstruct[:, start_idx:start_idx+self.patch_nums[i], :])
-            start_idx += self.patch_nums[i]
-            cur_orginal_patch = patched_spectra[i].permute(0,2,1)   
-            loss_reconstruct += compute_reconstruct_loss(cur_reconstructed_patch, cur_orginal_patch, masks[i])
+        with stage("specformer_reconstruct"):
+            z_reconstruct = z.clone()
+            loss_reconstruct = 0
+            start_idx = 0
+            for i in range(len(spectra)):
+                cur_reconstructed_patch = self.reconstruct_heads[i](z_reconstruct[:, start_idx:start_idx+self.patch_nums[i], :])
+                start_idx += self.patch_nums[i]
+                cur_orginal_patch = patched_spectra[i].permute(0,2,1)   
+                loss_reconstruct += compute_reconstruct_loss(cur_reconstructed_patch, cur_orginal_patch, masks[i])
 
         # flatten and linear to get representations
-        z = self.head(z)              # z: [bs x patch_num x d_model] -> z: [bs x output_dim]
-        z = self.out_norm(z)
+        with stage("specformer_head"):
+            z = self.head(z)              # z: [bs x patch_num x d_model] -> z: [bs x output_dim]
+            z = self.out_norm(z)
         return z, loss_reconstruct
 
 
@@ -282,7 +300,7 @@ def compute_reconstruct_loss(preds, target, mask):
         preds:   [bs x num_patch x patch_len]
         targets: [bs x num_patch x patch_len] 
         """
-        loss = (preds - target) ** 2
+        loss = (preds.float() - target.float()) ** 2
         loss = loss.mean(dim=-1)
         loss = (loss * mask).sum() / mask.sum()
         return loss
@@ -1,5 +1,10 @@
-from .Sp import CNN_AM
-from .Sp import SpecFormer
+import importlib
+
+# the spectra models are imported on first access
+_models = {
+    "CNN_AM": (".Sp", "CNN_AM"),
+    "SpecFormer": (".Sp", "SpecFormer"),
+}
 
 __all__ = [
     "graph-network",
@@ -8,3 +13,22 @@ __all__ = [
     "CNN-AM",
     "SpecFormer",
 ]
+
+# names of the output models, distance expansions and activations, available without
+# importing the models (see output_modules, rbf_class_mapping and act_class_mapping)
+output_models = ["Scalar", "DipoleMoment", "ElectronicSpatialExtent"]
+rbf_types = ["gauss", "expnorm", "gauss_tab", "expnorm_tab"]
+activations = ["ssp", "silu", "tanh", "sigmoid"]
+
+
+def __getattr__(name):
+    if name not in _models:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module, attr = _models[name]
+    model = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = model
+    return model
+
+
+def __dir__():
+    return sorted(set(list(globals()) + list(_models)))
@@ -1,4 +1,3 @@
-import re
 from typing import Optional, List, Tuple
 import torch
 from torch.autograd import grad
@@ -7,6 +6,8 @@ from torch_scatter import scatter
 from pytorch_lightning.utilities import rank_zero_warn
 from torchmdnet.models import output_modules
 from torchmdnet.models.wrappers import AtomFilter
+from torchmdnet.models.utils import upcast
+from torchmdnet.profiling import stage
 from torchmdnet import priors
 import warnings
 
@@ -32,11 +33,16 @@ def create_model(args, prior_model=None, mean=None, std=None):
 
         is_equivariant = False
         representation_model = TorchMD_GN(
-            num_filters=args["embedding_dimension"], aggr=args["aggr"], **shared_args
+            num_filters=args["embedding_dimension"],
+            aggr=args["aggr"],
+            half_edges=args.get("half_edges", False),
+            **shared_args,
         )
     elif args["model"] == "transformer":
         from torchmdnet.models.torchmd_t import TorchMD_T
 
+        if args.get("half_edges", False):
+            raise ValueError("Half edges are not supported by the transformer model.")
         is_equivariant = False
         representation_model = TorchMD_T(
             attn_activation=args["attn_activation"],
@@ -54,6 +60,7 @@ def create_model(args, prior_model=None, mean=None, std=None):
             distance_influence=args["distance_influence"],
             layernorm_on_vec=args["layernorm_on_vec"],
             use_dataset_md17=args["use_dataset_md17"],
+            half_edges=args.get("half_edges", False),
             **shared_args,
         )
     else:
@@ -142,12 +149,40 @@ def create_model(args, prior_model=None, mean=None, std=None):
         representation_spec_model=representation_spec_model,
         output_model_spec=output_model_spec,
         output_model_mol=output_model_mol,
+        fuse_output_heads=args.get("fuse_output_heads", False),
     )
     return model
 
 
+def _load_checkpoint(filepath):
+    # memory-map the checkpoint if supported, tensors are then only read when used
+    try:
+        return torch.load(filepath, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # older PyTorch versions or checkpoints in the legacy (non-zip) format
+        return torch.load(filepath, map_location="cpu")
+
+
+def _remap_key(key):
+    if key.startswith("model."):
+        key = key[len("model."):]
+    return key.replace("output_model_noise.0", "output_model_noise")
+
+
+def extract_weights(filepath, output_path):
+    r"""Stores the model weights and hyperparameters of a training checkpoint in a
+    compact file without optimizer and scheduler states, which can be passed to
+    :func:`load_model` instead of the checkpoint."""
+    ckpt = _load_checkpoint(filepath)
+    state_dict = {_remap_key(k): v for k, v in ckpt["state_dict"].items()}
+    torch.save(
+        dict(state_dict=state_dict, hyper_parameters=dict(ckpt["hyper_parameters"])),
+        output_path,
+    )
+
+
 def load_model(filepath, args=None, device="cpu", mean=None, std=None, **kwargs):
-    ckpt = torch.load(filepath, map_location="cpu")
+    ckpt = _load_checkpoint(filepath)
     if args is None:
         args = ckpt["hyper_parameters"]
 
@@ -158,32 +193,19 @@ def load_model(filepath, args=None, device="cpu", mean=None, std=None, **kwargs)
 
     model = create_model(args)
 
-    state_dict = {re.sub(r"^model\.", "", k): v for k, v in ckpt["state_dict"].items()}
-
-    # NOTE for debug
-    new_state_dict = {}
-    for k, v in state_dict.items():
-        # if 'pos_normalizer' not in k:
-        if "output_model_noise.0" in k:
-            k = k.replace("output_model_noise.0", "output_model_noise")
-        if "head.2" in k:
-            continue
-        new_state_dict[k] = v
-
+    # rename the checkpoint keys and omit unknown and mismatching weights in a single pass
     current_model_dict = model.state_dict()
-    # ommit mismatching shape
-    new_state_dict2 = {}
-    for k in current_model_dict:
-        if k in new_state_dict:
-            # print(k, current_model_dict[k].size(), new_state_dict[k].size())
-            if current_model_dict[k].size() == new_state_dict[k].size():
-                new_state_dict2[k] = new_state_dict[k]
-            else:
-                print(f"warning {k} shape mismatching, not loaded")
-                new_state_dict2[k] = current_model_dict[k]
+    state_dict = {}
+    for k, v in ckpt["state_dict"].items():
+        k = _remap_key(k)
+        if "head.2" in k or k not in current_model_dict:
+            continue
+        if current_model_dict[k].size() != v.size():
+            print(f"warning {k} shape mismatching, not loaded")
+            continue
+        state_dict[k] = v
 
-    # loading_return = model.load_state_dict(state_dict, strict=False)
-    loading_return = model.load_state_dict(new_state_dict2, strict=False)
+    loading_return = model.load_state_dict(state_dict, strict=False)
 
     if len(loading_return.unexpected_keys) > 0:
         # Should only happen if not applying denoising during fine-tuning.
@@ -207,6 +229,23 @@ def load_model(filepath, args=None, device="cpu", mean=None, std=None, **kwargs)
     return model.to(device)
 
 
+def aggregate(x, z, batch, reduce_op: str, atom_filter: int):
+    r"""Reduces atomic features to molecular features with :obj:`reduce_op`. Atoms with
+    :obj:`z <= atom_filter` are masked instead of removed, which keeps all shapes
+    static and avoids device synchronizations."""
+    x = upcast(x)
+    if atom_filter < 0:
+        return scatter(x, batch, dim=0, reduce=reduce_op)
+
+    mask = (z > atom_filter).unsqueeze(1)
+    if reduce_op == "max":
+        return scatter(x.masked_fill(~mask, float("-inf")), batch, dim=0, reduce="max")
+    out = scatter(x * mask, batch, dim=0, reduce="sum")
+    if reduce_op == "mean":
+        out = out / scatter(mask.to(out.dtype), batch, dim=0, reduce="sum")
+    return out
+
+
 class TorchMD_Net(nn.Module):
 
     def __init__(
@@ -223,6 +262,7 @@ class TorchMD_Net(nn.Module):
         representation_spec_model=None,
         output_model_spec=None,
         output_model_mol=None,
+        fuse_output_heads=False,
     ):
         super(TorchMD_Net, self).__init__()
         self.representation_model = representation_model
@@ -240,12 +280,22 @@ class TorchMD_Net(nn.Module):
             )
 
         self.reduce_op = reduce_op
+        # atoms excluded from the reduction, see AtomFilter
+        self.atom_filter = (
+            representation_model.remove_threshold
+            if isinstance(representation_model, AtomFilter)
+            else -1
+        )
+        for head in [output_model, output_model_noise, output_model_mol]:
+            if hasattr(head, "atom_filter"):
+                head.atom_filter = self.atom_filter
         self.derivative = derivative
         self.output_model_noise = output_model_noise        
         self.position_noise_scale = position_noise_scale
 
         self.output_model_spec = output_model_spec
         self.output_model_mol = output_model_mol
+        self.fuse_output_heads = fuse_output_heads
 
         mean = torch.scalar_tensor(0) if mean is None else mean
         self.register_buffer("mean", mean)
@@ -279,64 +329,151 @@ class TorchMD_Net(nn.Module):
             pos.requires_grad_(True)
 
         # run the potentially wrapped representation model
-        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
+        with stage("representation"):
+            x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
 
         # construct spectra feature
         spec_feature = None
         loss_reconstruct = None
         if self.representation_spec_model is not None:
             if spec_list is not None:
-                spec_feature = self.representation_spec_model(spec_list)
+                with stage("spectra_model"):
+                    spec_feature = self.representation_spec_model(spec_list)
             if spec_feature is not None and len(spec_feature) == 2:
                 spec_feature, loss_reconstruct = spec_feature
 
-        # construct molecule feature
-        mol_feature = scatter(x, batch, dim=0, reduce=self.reduce_op)
+        # apply the output, noise and molecule feature networks, fused into
+        # batched matrix multiplications if enabled and possible
+        heads = [self.output_model]
+        if self.output_model_noise is not None:
+            heads.append(self.output_model_noise)
         if self.output_model_mol is not None:
-            mol_feature = self.output_model_mol.pre_reduce(x, v, z, pos, batch)
-            mol_feature = scatter(mol_feature, batch, dim=0, reduce=self.reduce_op)
+            heads.append(self.output_model_mol)
+        with stage("output_heads"):
+            if self.fuse_output_heads and output_modules.can_fuse(heads):
+                head_outputs = output_modules.fused_pre_reduce(heads, x, v, z, pos, batch)
+            else:
+                head_outputs = [head.pre_reduce(x, v, z, pos, batch) for head in heads]
+
+        with stage("reduce"):
+            # construct molecule feature
+            if self.output_model_mol is not None:
+                mol_feature = self.aggregate(head_outputs[-1], z, batch)
+            else:
+                mol_feature = self.aggregate(x, z, batch)
+
+            out = self.reduce_output(head_outputs[0], z, pos, batch)
 
         # predict noise
         noise_pred = None
         if self.output_model_noise is not None:
-            noise_pred = self.output_model_noise.pre_reduce(x, v, z, pos, batch) 
-
-        # apply the output network
-        x = self.output_model.pre_reduce(x, v, z, pos, batch)
+            noise_pred = head_outputs[1]
 
-        # scale by data standard deviation
-        if self.std is not None:
-            x = x * self.std
+        # compute gradients with respect to coordinates
+        if self.derivative:
+            grad_outputs: List[Optional[torch.Tensor]] = [torch.ones_like(out)]
+            with stage("derivative"):
+                dy = grad(
+                    [out],
+                    [pos],
+                    grad_outputs=grad_outputs,
+                    create_graph=True,
+                    retain_graph=True,
+                )[0]
+            if dy is None:
+                raise RuntimeError("Autograd returned None for the force prediction.")
+            return out, noise_pred, -dy, spec_feature, mol_feature, loss_reconstruct
+        # TODO: return only `out` once Union typing works with TorchScript (https://github.com/pytorch/pytorch/pull/53180)
+        return out, noise_pred, None, spec_feature, mol_feature, loss_reconstruct
 
-        # apply prior model
+    def reduce_output(self, x, z, pos, batch):
+        r"""Turns the atomic outputs of the output model into the molecular prediction."""
+        # scale by data standard deviation and apply prior model
         if self.prior_model is not None:
-            x = self.prior_model(x, z, pos, batch)
+            x = self.prior_model.scale_and_apply(x, self.std, z, pos, batch)
+        elif self.std is not None:
+            x = x * self.std
 
         # aggregate atoms
-        out = scatter(x, batch, dim=0, reduce=self.reduce_op)
+        out = self.aggregate(x, z, batch)
 
         # shift by data mean
         if self.mean is not None:
             out = out + self.mean
 
         # apply output model after reduction
-        out = self.output_model.post_reduce(out)
+        return self.output_model.post_reduce(out)
 
-        # compute gradients with respect to coordinates
-        if self.derivative:
-            grad_outputs: List[Optional[torch.Tensor]] = [torch.ones_like(out)]
-            dy = grad(
-                [out],
-                [pos],
-                grad_outputs=grad_outputs,
-                create_graph=True,
-                retain_graph=True,
-            )[0]
-            if dy is None:
-                raise RuntimeError("Autograd returned None for the force prediction.")
-            return out, noise_pred, -dy, spec_feature, mol_feature, loss_reconstruct
-        # TODO: return only `out` once Union typing works with TorchScript (https://github.com/pytorch/pytorch/pull/53180)
-        return out, noise_pred, None, spec_feature, mol_feature, loss_reconstruct
+    def predict(self, z, pos, batch):
+        r"""Computes only the target prediction, without the spectra, noise and molecule
+        feature heads and without the derivative. Used for inference."""
+        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
+        x = self.output_model.pre_reduce(x, v, z, pos, batch)
+        return self.reduce_output(x, z, pos, batch)
+
+    def aggregate(self, x, z, batch):
+        r"""Reduces atomic features to molecular features, without the atoms removed by
+        the atom filter."""
+        return aggregate(x, z, batch, self.reduce_op, self.atom_filter)
+
+    def molecule_embedding(self, z, pos, batch):
+        r"""Computes the molecule features of the contrastive task, as in :meth:`forward`."""
+        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
+        if self.output_model_mol is not None:
+            x = self.output_model_mol.pre_reduce(x, v, z, pos, batch)
+        return self.aggregate(x, z, batch)
+
+    def spectra_embedding(self, spec_list):
+        r"""Computes the spectra features of the contrastive task. Spectra are not masked."""
+        assert self.representation_spec_model is not None, "The model has no spectra model."
+        if hasattr(self.representation_spec_model, "encode"):
+            return self.representation_spec_model.encode(spec_list)
+        return self.representation_spec_model(spec_list)
+
+
+class CompiledForward(object):
+    r"""Runs :meth:`TorchMD_Net.forward` through :func:`torch.compile` with dynamic shapes.
+
+    To limit recompilations, the atoms of every batch are padded to a multiple of
+    :obj:`bucket_size` with a dummy molecule of hydrogen atoms, which are placed
+    further apart than the cutoff so that they have no neighbors. The dummy
+    molecule is removed from the outputs again. This is a plain object and not a
+    module, so compiling a model does not change its state dict.
+
+    Args:
+        model (TorchMD_Net): The model to compile.
+        cutoff (float): Upper cutoff of the representation model.
+        bucket_size (int, optional): Pad the number of atoms to a multiple of this,
+            no padding if 0. (default: :obj:`64`)
+    """
+
+    def __init__(self, model, cutoff, bucket_size=64):
+        assert hasattr(torch, "compile"), "torch.compile requires PyTorch 2.0 or newer."
+        self.forward = torch.compile(model.forward, dynamic=True)
+        self.spacing = cutoff + 1.0
+        self.bucket_size = bucket_size
+
+    def __call__(self, z, pos, spec_list, batch, num_graphs):
+        num_atoms = z.size(0)
+        num_pad = -num_atoms % self.bucket_size if self.bucket_size > 0 else 0
+        if num_pad > 0:
+            dummy_pos = torch.zeros(num_pad, 3, dtype=pos.dtype, device=pos.device)
+            dummy_pos[:, 0] = torch.arange(num_pad, device=pos.device) * self.spacing
+            z = torch.cat([z, z.new_ones(num_pad)])
+            pos = torch.cat([pos, dummy_pos])
+            batch = torch.cat([batch, batch.new_full((num_pad,), num_graphs)])
+
+        out, noise_pred, deriv, spec_feature, mol_feature, loss_reconstruct = self.forward(
+            z, pos, spec_list, batch=batch
+        )
+
+        if num_pad > 0:
+            out, mol_feature = out[:num_graphs], mol_feature[:num_graphs]
+            if noise_pred is not None:
+                noise_pred = noise_pred[:num_atoms]
+            if deriv is not None:
+                deriv = deriv[:num_atoms]
+        return out, noise_pred, deriv, spec_feature, mol_feature, loss_reconstruct
 
 
 class AccumulatedNormalization(nn.Module):
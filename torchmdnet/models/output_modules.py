@@ -1,13 +1,32 @@
 from abc import abstractmethod, ABCMeta
 from typing import Optional
-import ase
-from torchmdnet.models.utils import act_class_mapping, GatedEquivariantBlock
+from torchmdnet.models.utils import (
+    act_class_mapping,
+    GatedEquivariantBlock,
+    fused_gated_equivariant_blocks,
+)
 from torch_scatter import scatter
 import torch
 from torch import nn
+from torchmdnet.models import output_models
 
 
-__all__ = ["Scalar", "DipoleMoment", "ElectronicSpatialExtent"]
+__all__ = list(output_models)
+
+
+def _atomic_masses():
+    # ase is only imported by the dipole and electronic spatial extent heads
+    from ase.data import atomic_masses
+
+    return torch.from_numpy(atomic_masses).float()
+
+
+def _center_of_mass(atomic_mass, z, pos, batch, atom_filter: int):
+    # atoms excluded by the atom filter do not count towards the center of mass
+    mass = atomic_mass[z].view(-1, 1)
+    if atom_filter > -1:
+        mass = mass * (z > atom_filter).unsqueeze(1)
+    return scatter(mass * pos, batch, dim=0) / scatter(mass, batch, dim=0)
 
 
 class OutputModel(nn.Module, metaclass=ABCMeta):
@@ -72,6 +91,9 @@ class EquivariantScalar(OutputModel):
     def pre_reduce(self, x, v, z, pos, batch):
         for layer in self.output_network:
             x, v = layer(x, v)
+        return self.post_network(x, v, z, pos, batch)
+
+    def post_network(self, x, v, z, pos, batch):
         # include v in output to make sure all parameters have a gradient
         return x + v.sum() * 0
 
@@ -81,15 +103,16 @@ class DipoleMoment(Scalar):
         super(DipoleMoment, self).__init__(
             hidden_channels, activation, allow_prior_model=False
         )
-        atomic_mass = torch.from_numpy(ase.data.atomic_masses).float()
+        atomic_mass = _atomic_masses()
         self.register_buffer("atomic_mass", atomic_mass)
+        # set by TorchMD_Net, see AtomFilter
+        self.atom_filter = -1
 
     def pre_reduce(self, x, v: Optional[torch.Tensor], z, pos, batch):
         x = self.output_network(x)
 
         # Get center of mass.
-        mass = self.atomic_mass[z].view(-1, 1)
-        c = scatter(mass * pos, batch, dim=0) / scatter(mass, batch, dim=0)
+        c = _center_of_mass(self.atomic_mass, z, pos, batch, self.atom_filter)
         x = x * (pos - c[batch])
         return x
 
@@ -102,16 +125,14 @@ class EquivariantDipoleMoment(EquivariantScalar):
         super(EquivariantDipoleMoment, self).__init__(
             hidden_channels, activation, allow_prior_model=False
         )
-        atomic_mass = torch.from_numpy(ase.data.atomic_masses).float()
+        atomic_mass = _atomic_masses()
         self.register_buffer("atomic_mass", atomic_mass)
+        # set by TorchMD_Net, see AtomFilter
+        self.atom_filter = -1
 
-    def pre_reduce(self, x, v, z, pos, batch):
-        for layer in self.output_network:
-            x, v = layer(x, v)
-
+    def post_network(self, x, v, z, pos, batch):
         # Get center of mass.
-        mass = self.atomic_mass[z].view(-1, 1)
-        c = scatter(mass * pos, batch, dim=0) / scatter(mass, batch, dim=0)
+        c = _center_of_mass(self.atomic_mass, z, pos, batch, self.atom_filter)
         x = x * (pos - c[batch])
         return x + v.squeeze()
 
@@ -128,8 +149,10 @@ class ElectronicSpatialExtent(OutputModel):
             act_class(),
             nn.Linear(hidden_channels // 2, 1),
         )
-        atomic_mass = torch.from_numpy(ase.data.atomic_masses).float()
+        atomic_mass = _atomic_masses()
         self.register_buffer("atomic_mass", atomic_mass)
+        # set by TorchMD_Net, see AtomFilter
+        self.atom_filter = -1
 
         self.reset_parameters()
 
@@ -143,8 +166,7 @@ class ElectronicSpatialExtent(OutputModel):
         x = self.output_network(x)
 
         # Get center of mass.
-        mass = self.atomic_mass[z].view(-1, 1)
-        c = scatter(mass * pos, batch, dim=0) / scatter(mass, batch, dim=0)
+        c = _center_of_mass(self.atomic_mass, z, pos, batch, self.atom_filter)
 
         x = torch.norm(pos - c[batch], dim=1, keepdim=True) ** 2 * x
         return x
@@ -160,7 +182,34 @@ class EquivariantVectorOutput(EquivariantScalar):
             hidden_channels, activation, allow_prior_model=False
         )
 
-    def pre_reduce(self, x, v, z, pos, batch):
-        for layer in self.output_network:
-            x, v = layer(x, v)
+    def post_network(self, x, v, z, pos, batch):
         return v.squeeze()
+
+
+def can_fuse(heads):
+    r"""Whether the output networks of :obj:`heads` can be computed together by
+    :func:`fused_pre_reduce`, which requires equivariant heads of identical shape."""
+    if len(heads) < 2 or not all(isinstance(head, EquivariantScalar) for head in heads):
+        return False
+
+    def signature(head):
+        return [
+            (
+                [p.shape for p in layer.parameters()],
+                type(layer.update_net[1]),
+                type(layer.act),
+            )
+            for layer in head.output_network
+        ]
+
+    return all(signature(head) == signature(heads[0]) for head in heads[1:])
+
+
+def fused_pre_reduce(heads, x, v, z, pos, batch):
+    r"""Computes :meth:`pre_reduce` of several :class:`EquivariantScalar` heads on the same
+    features. Every layer of all output networks is computed with a single batched
+    matrix multiplication, only the head specific post processing is run per head.
+    The heads keep their own parameters, so the state dict does not change."""
+    for layers in zip(*[head.output_network for head in heads]):
+        x, v = fused_gated_equivariant_blocks(layers, x, v)
+    return [head.post_network(x[k], v[k], z, pos, batch) for k, head in enumerate(heads)]
@@ -7,6 +7,8 @@ from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
     Distance,
+    mirror_edges,
+    upcast,
     rbf_class_mapping,
     act_class_mapping,
 )
@@ -50,6 +52,9 @@ class TorchMD_ET(nn.Module):
             higher values if they are using higher upper distance cutoffs and expect more
             than 32 neighbors per node/atom.
             (default: :obj:`32`)
+        half_edges (bool, optional): Whether to compute the distance expansion, cutoff
+            and distance projections once per atom pair instead of once per direction.
+            (default: :obj:`False`)
     """
 
     def __init__(
@@ -71,6 +76,7 @@ class TorchMD_ET(nn.Module):
         layernorm_on_vec=None,
         use_dataset_md17=False,
         # use_dataset_md17=True,
+        half_edges=False,
     ):
         super(TorchMD_ET, self).__init__()
 
@@ -102,6 +108,7 @@ class TorchMD_ET(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.layernorm_on_vec = layernorm_on_vec
+        self.half_edges = half_edges
 
         self.use_dataset_md17 = use_dataset_md17
         if self.use_dataset_md17:
@@ -117,6 +124,7 @@ class TorchMD_ET(nn.Module):
             max_num_neighbors=max_num_neighbors,
             return_vecs=True,
             loop=True,
+            half_edges=half_edges,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
             cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
@@ -130,9 +138,9 @@ class TorchMD_ET(nn.Module):
         )
 
         self.attention_layers = nn.ModuleList()
-        if not self.use_dataset_md17:
-            self.x_norms = nn.ModuleList()
-            self.vec_norms = nn.ModuleList()
+        # without layer norms the lists hold identities, so that the model can be scripted
+        self.x_norms = nn.ModuleList()
+        self.vec_norms = nn.ModuleList()
         for _ in range(num_layers):
             layer = EquivariantMultiHeadAttention(
                 hidden_channels,
@@ -148,8 +156,12 @@ class TorchMD_ET(nn.Module):
             if not self.use_dataset_md17:
                 self.x_norms.append(nn.LayerNorm(hidden_channels))
                 self.vec_norms.append(EquivariantLayerNorm(hidden_channels))
+            else:
+                self.x_norms.append(nn.Identity())
+                self.vec_norms.append(nn.Identity())
 
         self.out_norm = nn.LayerNorm(hidden_channels)
+        self.out_norm_vec = None
         if self.layernorm_on_vec:
             if self.layernorm_on_vec == "whitened":
                 self.out_norm_vec = EquivariantLayerNorm(hidden_channels)
@@ -169,7 +181,7 @@ class TorchMD_ET(nn.Module):
                 self.x_norms[layer_idx].reset_parameters()
                 self.vec_norms[layer_idx].reset_parameters()
         self.out_norm.reset_parameters()
-        if self.layernorm_on_vec:
+        if self.out_norm_vec is not None:
             self.out_norm_vec.reset_parameters()
 
     def forward(self, z, pos, batch):
@@ -184,24 +196,30 @@ class TorchMD_ET(nn.Module):
         mask = edge_index[0] != edge_index[1]
         edge_vec[mask] = edge_vec[mask] / torch.norm(edge_vec[mask], dim=1).unsqueeze(1)
 
+        edge_map: Optional[torch.Tensor] = None
+        if self.half_edges:
+            edge_index, edge_map, sign = mirror_edges(edge_index)
+            edge_vec = edge_vec[edge_map] * sign.unsqueeze(1)
+
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr, edge_map)
 
         vec = torch.zeros(x.size(0), 3, x.size(1), device=x.device)
 
-        for layer_idx, attn in enumerate(self.attention_layers):
-            dx, dvec = attn(x, vec, edge_index, edge_weight, edge_attr, edge_vec)
-            x = x + dx  # may be nan
+        for attn, x_norm, vec_norm in zip(self.attention_layers, self.x_norms, self.vec_norms):
+            dx, dvec = attn(x, vec, edge_index, edge_weight, edge_attr, edge_vec, edge_map)
+            # the residual stream is accumulated in float32, also under bfloat16 autocast
+            x = upcast(x) + dx  # may be nan
             vec = vec + dvec
             if not self.use_dataset_md17:
-                x = self.x_norms[layer_idx](x)
-                vec = self.vec_norms[layer_idx](vec)
+                x = x_norm(upcast(x))
+                vec = vec_norm(vec)
 
         if torch.max(x) > 1e15:
             print(f'x is tooooo large: {torch.max(x)}')
 
-        xnew = self.out_norm(x)
-        if self.layernorm_on_vec:
+        xnew = self.out_norm(upcast(x))
+        if self.out_norm_vec is not None:
             vec = self.out_norm_vec(vec)
 
         return xnew, vec, z, pos, batch
@@ -220,7 +238,8 @@ class TorchMD_ET(nn.Module):
             f"num_heads={self.num_heads}, "
             f"distance_influence={self.distance_influence}, "
             f"cutoff_lower={self.cutoff_lower}, "
-            f"cutoff_upper={self.cutoff_upper})"
+            f"cutoff_upper={self.cutoff_upper}, "
+            f"half_edges={self.half_edges})"
         )
 
 
@@ -288,7 +307,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
             nn.init.xavier_uniform_(self.dv_proj.weight)
             self.dv_proj.bias.data.fill_(0)
 
-    def forward(self, x, vec, edge_index, r_ij, f_ij, d_ij):
+    def forward(self, x, vec, edge_index, r_ij, f_ij, d_ij, edge_map: Optional[torch.Tensor] = None):
         x = self.layernorm(x)
         q = self.q_proj(x).reshape(-1, self.num_heads, self.head_dim)
         k = self.k_proj(x).reshape(-1, self.num_heads, self.head_dim)
@@ -308,8 +327,16 @@ class EquivariantMultiHeadAttention(MessagePassing):
             if self.dv_proj is not None
             else None
         )
-
-        # propagate_type: (q: Tensor, k: Tensor, v: Tensor, vec: Tensor, dk: Tensor, dv: Tensor, r_ij: Tensor, d_ij: Tensor)
+        c_ij = self.cutoff(r_ij)
+        if edge_map is not None:
+            # distance features were computed once per atom pair
+            c_ij = c_ij[edge_map]
+            if dk is not None:
+                dk = dk[edge_map]
+            if dv is not None:
+                dv = dv[edge_map]
+
+        # propagate_type: (q: Tensor, k: Tensor, v: Tensor, vec: Tensor, dk: Tensor, dv: Tensor, c_ij: Tensor, d_ij: Tensor)
         x, vec = self.propagate(
             edge_index,
             q=q,
@@ -318,7 +345,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
             vec=vec,
             dk=dk,
             dv=dv,
-            r_ij=r_ij,
+            c_ij=c_ij,
             d_ij=d_ij,
             size=None,
         )
@@ -330,7 +357,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
         dvec = vec3 * o1.unsqueeze(1) + vec
         return dx, dvec
 
-    def message(self, q_i, k_j, v_j, vec_j, dk, dv, r_ij, d_ij):
+    def message(self, q_i, k_j, v_j, vec_j, dk, dv, c_ij, d_ij):
         # attention mechanism
         if dk is None:
             attn = (q_i * k_j).sum(dim=-1)
@@ -338,7 +365,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
             attn = (q_i * k_j * dk).sum(dim=-1)
 
         # attention activation function
-        attn = self.attn_activation(attn) * self.cutoff(r_ij).unsqueeze(1)
+        attn = self.attn_activation(attn) * c_ij.unsqueeze(1)
 
         # value pathway
         if dv is not None:
@@ -361,8 +388,9 @@ class EquivariantMultiHeadAttention(MessagePassing):
         dim_size: Optional[int],
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         x, vec = features
-        x = scatter(x, index, dim=self.node_dim, dim_size=dim_size)
-        vec = scatter(vec, index, dim=self.node_dim, dim_size=dim_size)
+        # accumulate messages in float32 under bfloat16 autocast
+        x = scatter(upcast(x), index, dim=self.node_dim, dim_size=dim_size)
+        vec = scatter(upcast(vec), index, dim=self.node_dim, dim_size=dim_size)
         return x, vec
 
     def update(
@@ -420,7 +448,8 @@ class EquivariantLayerNorm(nn.Module):
         """
         _, s, v = matrix.svd()
         good = (
-            s > s.max(-1, True).values * s.size(-1) * torch.finfo(s.dtype).eps
+            # machine epsilon of float64, _forward computes in double precision
+            s > s.max(-1, True).values * s.size(-1) * 2.220446049250313e-16
         )
         components = good.sum(-1)
         common = components.max()
@@ -437,6 +466,13 @@ class EquivariantLayerNorm(nn.Module):
         )
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._forward(input)
+        # the whitening is never run in reduced precision, also not under autocast
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            return self._forward(input)
+
+    def _forward(self, input: torch.Tensor) -> torch.Tensor:
         input = input.to(torch.float64) # Need double precision for accurate inversion.
         input = self.mean_center(input)
         # We use different diagonal elements in case input matrix is approximately zero,
@@ -1,9 +1,12 @@
+from typing import Optional
+import torch
 from torch import nn
 from torch_geometric.nn import MessagePassing
 from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
     Distance,
+    mirror_edges,
     rbf_class_mapping,
     act_class_mapping,
 )
@@ -53,6 +56,9 @@ class TorchMD_GN(nn.Module):
             convolution ouput. Can be one of 'add', 'mean', or 'max' (see
             https://pytorch-geometric.readthedocs.io/en/latest/notes/create_gnn.html
             for more details). (default: :obj:`"add"`)
+        half_edges (bool, optional): Whether to compute the distance expansion and
+            filters once per atom pair instead of once per direction.
+            (default: :obj:`False`)
     """
 
     def __init__(
@@ -70,6 +76,7 @@ class TorchMD_GN(nn.Module):
         max_z=100,
         max_num_neighbors=32,
         aggr="add",
+        half_edges=False,
     ):
         super(TorchMD_GN, self).__init__()
 
@@ -99,13 +106,17 @@ class TorchMD_GN(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.aggr = aggr
+        self.half_edges = half_edges
 
         act_class = act_class_mapping[activation]
 
         self.embedding = nn.Embedding(self.max_z, hidden_channels)
 
         self.distance = Distance(
-            cutoff_lower, cutoff_upper, max_num_neighbors=max_num_neighbors
+            cutoff_lower,
+            cutoff_upper,
+            max_num_neighbors=max_num_neighbors,
+            half_edges=half_edges,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
             cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
@@ -147,11 +158,15 @@ class TorchMD_GN(nn.Module):
         edge_index, edge_weight, _ = self.distance(pos, batch)
         edge_attr = self.distance_expansion(edge_weight)
 
+        edge_map: Optional[torch.Tensor] = None
+        if self.half_edges:
+            edge_index, edge_map, _ = mirror_edges(edge_index)
+
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr, edge_map)
 
         for interaction in self.interactions:
-            x = x + interaction(x, edge_index, edge_weight, edge_attr)
+            x = x + interaction(x, edge_index, edge_weight, edge_attr, edge_map)
 
         return x, None, z, pos, batch
 
@@ -168,6 +183,7 @@ class TorchMD_GN(nn.Module):
             f"neighbor_embedding={self.neighbor_embedding}, "
             f"cutoff_lower={self.cutoff_lower}, "
             f"cutoff_upper={self.cutoff_upper}, "
+            f"half_edges={self.half_edges}, "
             f"aggr={self.aggr})"
         )
 
@@ -212,8 +228,8 @@ class InteractionBlock(nn.Module):
         nn.init.xavier_uniform_(self.lin.weight)
         self.lin.bias.data.fill_(0)
 
-    def forward(self, x, edge_index, edge_weight, edge_attr):
-        x = self.conv(x, edge_index, edge_weight, edge_attr)
+    def forward(self, x, edge_index, edge_weight, edge_attr, edge_map: Optional[torch.Tensor] = None):
+        x = self.conv(x, edge_index, edge_weight, edge_attr, edge_map)
         x = self.act(x)
         x = self.lin(x)
         return x
@@ -243,9 +259,12 @@ class CFConv(MessagePassing):
         nn.init.xavier_uniform_(self.lin2.weight)
         self.lin2.bias.data.fill_(0)
 
-    def forward(self, x, edge_index, edge_weight, edge_attr):
+    def forward(self, x, edge_index, edge_weight, edge_attr, edge_map: Optional[torch.Tensor] = None):
         C = self.cutoff(edge_weight)
         W = self.net(edge_attr) * C.view(-1, 1)
+        if edge_map is not None:
+            # filters were computed once per atom pair
+            W = W[edge_map]
 
         x = self.lin1(x)
         # propagate_type: (x: Tensor, W: Tensor)
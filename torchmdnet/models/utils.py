@@ -1,4 +1,6 @@
 import math
+import warnings
+from typing import Optional
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -37,6 +39,14 @@ def visualize_basis(basis_type, num_rbf=50, cutoff_lower=0, cutoff_upper=5):
     plt.show()
 
 
+def upcast(tensor):
+    r"""Returns float16 and bfloat16 tensors as float32, other tensors unchanged.
+    Used for the parts of the model that stay in float32 under bfloat16 autocast."""
+    if tensor.dtype == torch.float16 or tensor.dtype == torch.bfloat16:
+        return tensor.float()
+    return tensor
+
+
 class NeighborEmbedding(MessagePassing):
     def __init__(self, hidden_channels, num_rbf, cutoff_lower, cutoff_upper, max_z=100):
         super(NeighborEmbedding, self).__init__(aggr="add")
@@ -54,16 +64,18 @@ class NeighborEmbedding(MessagePassing):
         self.distance_proj.bias.data.fill_(0)
         self.combine.bias.data.fill_(0)
 
-    def forward(self, z, x, edge_index, edge_weight, edge_attr):
+    def forward(self, z, x, edge_index, edge_weight, edge_attr, edge_map: Optional[torch.Tensor] = None):
+        C = self.cutoff(edge_weight)
+        W = self.distance_proj(edge_attr) * C.view(-1, 1)
+        if edge_map is not None:
+            # distance features were computed once per atom pair, see mirror_edges
+            W = W[edge_map]
+
         # remove self loops
         mask = edge_index[0] != edge_index[1]
         if not mask.all():
             edge_index = edge_index[:, mask]
-            edge_weight = edge_weight[mask]
-            edge_attr = edge_attr[mask]
-
-        C = self.cutoff(edge_weight)
-        W = self.distance_proj(edge_attr) * C.view(-1, 1)
+            W = W[mask]
 
         x_neighbors = self.embedding(z)
         # propagate_type: (x: Tensor, W: Tensor)
@@ -150,6 +162,100 @@ class ExpNormalSmearing(nn.Module):
         )
 
 
+class TabulatedMixin(object):
+    r"""Replaces the evaluation of a non-trainable distance expansion by a lookup table
+    with linear or cubic (Catmull-Rom) interpolation between :obj:`num_points`
+    equidistant distances in :obj:`[0, cutoff_upper]`. Cutoff functions of the
+    expansion are part of the table. Distances outside of the table are clamped to it.
+
+    If :obj:`num_points` is :obj:`None`, the table is refined until the maximum
+    absolute interpolation error is below :obj:`max_error`.
+    """
+
+    def _tabulate(self, num_points, interpolation, max_error):
+        assert not self.trainable, "Tabulated distance expansions require trainable_rbf=False."
+        assert interpolation in ["linear", "cubic"], f"Unknown interpolation {interpolation}."
+        self.interpolation = interpolation
+        self.max_error = max_error
+
+        refine = num_points is None
+        num_points = 256 if refine else num_points
+        while True:
+            coeffs, error = self._build_table(num_points)
+            if not refine or error <= max_error or num_points >= 2 ** 20:
+                break
+            num_points *= 2
+        if error > max_error:
+            warnings.warn(
+                f"Interpolation error {error:.2e} of the tabulated distance expansion exceeds {max_error:.2e}."
+            )
+        self.num_points = num_points
+        self.error = error
+        self.spacing = self.cutoff_upper / (num_points - 1)
+        self.register_buffer("coeffs", coeffs, persistent=False)
+
+    def _exact(self, dist):
+        return super(TabulatedMixin, self).forward(dist)
+
+    def _build_table(self, num_points):
+        # polynomial coefficients of every interval, evaluated in double precision
+        device = next(self.buffers()).device
+        x = torch.linspace(0, self.cutoff_upper, num_points, dtype=torch.float64, device=device)
+        with torch.no_grad():
+            y = self._exact(x).double()
+            if self.interpolation == "linear":
+                coeffs = torch.stack([y[:-1], y[1:] - y[:-1]], dim=1)
+            else:
+                # finite difference tangents, one sided at the ends of the table
+                m = torch.empty_like(y)
+                m[1:-1] = (y[2:] - y[:-2]) / 2
+                m[0], m[-1] = y[1] - y[0], y[-1] - y[-2]
+                p0, p1, m0, m1 = y[:-1], y[1:], m[:-1], m[1:]
+                coeffs = torch.stack(
+                    [p0, m0, -3 * p0 + 3 * p1 - 2 * m0 - m1, 2 * p0 - 2 * p1 + m0 + m1], dim=1
+                )
+            # the largest errors are in the middle of the intervals
+            mid = (x[:-1] + x[1:]) / 2
+            error = (self._horner(coeffs, 0.5) - self._exact(mid).double()).abs().max()
+        return coeffs.float(), error.item()
+
+    def _horner(self, c, t):
+        # evaluates the interval polynomials with coefficients c[:, k] at t
+        out = c[:, -1]
+        for k in range(c.shape[1] - 2, -1, -1):
+            out = out * t + c[:, k]
+        return out
+
+    def reset_parameters(self):
+        super(TabulatedMixin, self).reset_parameters()
+        self.coeffs.copy_(self._build_table(self.num_points)[0])
+
+    def forward(self, dist):
+        x = dist.clamp(0, self.cutoff_upper) / self.spacing
+        index = x.floor().long().clamp(max=self.num_points - 2)
+        t = (x - index).unsqueeze(-1)
+        return self._horner(self.coeffs[index], t)
+
+
+class TabulatedGaussianSmearing(TabulatedMixin, GaussianSmearing):
+    r""":class:`GaussianSmearing` evaluated from a lookup table, see :class:`TabulatedMixin`."""
+
+    def __init__(self, cutoff_lower=0.0, cutoff_upper=5.0, num_rbf=50, trainable=False,
+                 num_points=None, interpolation="cubic", max_error=1e-5):
+        super(TabulatedGaussianSmearing, self).__init__(cutoff_lower, cutoff_upper, num_rbf, trainable)
+        self._tabulate(num_points, interpolation, max_error)
+
+
+class TabulatedExpNormalSmearing(TabulatedMixin, ExpNormalSmearing):
+    r""":class:`ExpNormalSmearing` including its cosine cutoff evaluated from a lookup
+    table, see :class:`TabulatedMixin`."""
+
+    def __init__(self, cutoff_lower=0.0, cutoff_upper=5.0, num_rbf=50, trainable=False,
+                 num_points=None, interpolation="cubic", max_error=1e-5):
+        super(TabulatedExpNormalSmearing, self).__init__(cutoff_lower, cutoff_upper, num_rbf, trainable)
+        self._tabulate(num_points, interpolation, max_error)
+
+
 class ShiftedSoftplus(nn.Module):
     def __init__(self):
         super(ShiftedSoftplus, self).__init__()
@@ -190,6 +296,38 @@ class CosineCutoff(nn.Module):
             return cutoffs
 
 
+def mirror_edges(edge_index):
+    r"""Expands half edges, which contain every atom pair once (see :class:`Distance`),
+    to both directions. Features of the pairs are mapped to the edges with
+    :obj:`edge_map` and vectors pointing along the edges are multiplied by :obj:`sign`.
+    Self loops are not duplicated.
+
+    Returns:
+        The edge index, the pair of every edge and the sign of every edge.
+    """
+    pair = torch.arange(edge_index.size(1), device=edge_index.device)
+    mask = edge_index[0] != edge_index[1]
+    edge_map = torch.cat([pair, pair[mask]])
+    edge_index = torch.cat([edge_index, edge_index[:, mask].flip(0)], dim=1)
+    sign = torch.ones(edge_map.size(0), device=edge_index.device)
+    sign[pair.size(0):] = -1
+    return edge_index, edge_map, sign
+
+
+def half_edge_index(edge_index, num_nodes: int):
+    r"""Keeps every atom pair of :obj:`edge_index` once, as an edge :obj:`(i, j)` with
+    :obj:`i <= j`. Pairs are collected from both directions, so pairs which are only
+    contained in one direction, e.g. because :obj:`radius_graph` dropped neighbors
+    beyond :obj:`max_num_neighbors`, are kept as well. Mirroring the result (see
+    :func:`mirror_edges`) therefore gives the symmetrized graph.
+    """
+    # sort the atoms of every edge and remove duplicate pairs by a scalar key
+    low = torch.minimum(edge_index[0], edge_index[1])
+    high = torch.maximum(edge_index[0], edge_index[1])
+    key = torch.unique(low * num_nodes + high)
+    return torch.stack([key // num_nodes, key % num_nodes])
+
+
 class Distance(nn.Module):
     def __init__(
         self,
@@ -198,6 +336,7 @@ class Distance(nn.Module):
         max_num_neighbors=32,
         return_vecs=False,
         loop=False,
+        half_edges=False,
     ):
         super(Distance, self).__init__()
         self.cutoff_lower = cutoff_lower
@@ -205,6 +344,7 @@ class Distance(nn.Module):
         self.max_num_neighbors = max_num_neighbors
         self.return_vecs = return_vecs
         self.loop = loop
+        self.half_edges = half_edges
 
     def forward(self, pos, batch):
         edge_index = radius_graph(
@@ -214,6 +354,9 @@ class Distance(nn.Module):
             loop=self.loop,
             max_num_neighbors=self.max_num_neighbors,
         )
+        if self.half_edges:
+            # keep every atom pair once, expanded again by mirror_edges
+            edge_index = half_edge_index(edge_index, pos.size(0))
         edge_vec = pos[edge_index[0]] - pos[edge_index[1]]
 
         if self.loop:
@@ -238,6 +381,103 @@ class Distance(nn.Module):
         return edge_index, edge_weight, None
 
 
+class VerletDistance(Distance):
+    r"""Distance module that reuses its neighbor list between calls, for repeated
+    evaluations of slowly moving atoms as in molecular dynamics or geometry
+    optimization.
+
+    Candidate pairs are searched within :obj:`cutoff_upper + skin` and are only
+    searched again once an atom moved more than half the skin since the last search,
+    or when the atoms or their batch assignment change. Distances are computed for all
+    candidate pairs in every call and pairs beyond the cutoffs are dropped, so the
+    result matches :class:`Distance` as long as no atom exceeds the (scaled up)
+    maximum number of neighbors.
+
+    Args:
+        skin (float, optional): Verlet skin added to the upper cutoff.
+            (default: :obj:`0.5`)
+    """
+
+    def __init__(
+        self,
+        cutoff_lower,
+        cutoff_upper,
+        max_num_neighbors=32,
+        return_vecs=False,
+        loop=False,
+        half_edges=False,
+        skin=0.5,
+    ):
+        super(VerletDistance, self).__init__(
+            cutoff_lower, cutoff_upper, max_num_neighbors, return_vecs, loop, half_edges
+        )
+        self.skin = skin
+        # the search sphere is larger, allow proportionally more candidates
+        self.max_num_candidates = int(
+            math.ceil(max_num_neighbors * ((cutoff_upper + skin) / cutoff_upper) ** 3)
+        )
+        self.candidates = None
+        self.reference_pos = None
+        self.reference_batch = None
+        self.num_builds = 0
+
+    @classmethod
+    def from_distance(cls, distance, skin=0.5):
+        return cls(
+            distance.cutoff_lower,
+            distance.cutoff_upper,
+            distance.max_num_neighbors,
+            distance.return_vecs,
+            distance.loop,
+            distance.half_edges,
+            skin=skin,
+        )
+
+    def _needs_rebuild(self, pos, batch):
+        if self.candidates is None or self.reference_pos.shape != pos.shape:
+            return True
+        if not torch.equal(self.reference_batch, batch):
+            return True
+        displacement = (pos.detach() - self.reference_pos).norm(dim=-1).max()
+        return bool(displacement > 0.5 * self.skin)
+
+    def forward(self, pos, batch):
+        if self._needs_rebuild(pos, batch):
+            self.candidates = radius_graph(
+                pos.detach(),
+                r=self.cutoff_upper + self.skin,
+                batch=batch,
+                loop=self.loop,
+                max_num_neighbors=self.max_num_candidates,
+            )
+            if self.half_edges:
+                self.candidates = half_edge_index(self.candidates, pos.size(0))
+            self.reference_pos = pos.detach().clone()
+            self.reference_batch = batch.clone()
+            self.num_builds += 1
+
+        edge_index = self.candidates
+        edge_vec = pos[edge_index[0]] - pos[edge_index[1]]
+
+        if self.loop:
+            # mask out self loops when computing distances because
+            # the norm of 0 produces NaN gradients
+            mask = edge_index[0] != edge_index[1]
+            edge_weight = torch.zeros(edge_vec.size(0), device=edge_vec.device, dtype=edge_vec.dtype)
+            edge_weight[mask] = torch.norm(edge_vec[mask], dim=-1)
+        else:
+            edge_weight = torch.norm(edge_vec, dim=-1)
+
+        cutoff_mask = (edge_weight >= self.cutoff_lower) & (edge_weight <= self.cutoff_upper)
+        edge_index = edge_index[:, cutoff_mask]
+        edge_weight = edge_weight[cutoff_mask]
+
+        if self.return_vecs:
+            edge_vec = edge_vec[cutoff_mask]
+            return edge_index, edge_weight, edge_vec
+        return edge_index, edge_weight, None
+
+
 class GatedEquivariantBlock(nn.Module):
     """Gated Equivariant Block as defined in Schütt et al. (2021):
     Equivariant message passing for the prediction of tensorial properties and molecular spectra
@@ -290,7 +530,55 @@ class GatedEquivariantBlock(nn.Module):
         return x, v
 
 
-rbf_class_mapping = {"gauss": GaussianSmearing, "expnorm": ExpNormalSmearing}
+def fused_gated_equivariant_blocks(blocks, x, v):
+    r"""Applies several :class:`GatedEquivariantBlock` of equal shape, one per head, with
+    batched matrix multiplications. The weights of the blocks are stacked in every call,
+    so that the blocks keep their own parameters.
+
+    Args:
+        blocks (list of GatedEquivariantBlock): The blocks of the :math:`K` heads.
+        x (Tensor): Scalar features, either shared by all heads with shape
+            :math:`(N, C)` or per head with shape :math:`(K, N, C)`.
+        v (Tensor): Vector features, either shared with shape :math:`(N, 3, C)` or per
+            head with shape :math:`(K, N, 3, C)`.
+
+    Returns:
+        The scalar and vector outputs of all heads, with shapes :math:`(K, N, O)`
+        and :math:`(K, N, 3, O)`.
+    """
+    # both vector projections of all heads in one product
+    vec_weight = torch.stack([torch.cat([block.vec1_proj.weight, block.vec2_proj.weight]) for block in blocks])
+    if v.dim() == 3:
+        vec = torch.einsum("nsc,kdc->knsd", v, vec_weight)
+    else:
+        vec = torch.einsum("knsc,kdc->knsd", v, vec_weight)
+    hidden_channels = blocks[0].vec1_proj.out_features
+    vec1 = torch.norm(vec[..., :hidden_channels], dim=-2)
+    vec2 = vec[..., hidden_channels:]
+
+    if x.dim() == 2:
+        x = x.expand(len(blocks), -1, -1)
+    x = torch.cat([x, vec1], dim=-1)
+    for i in [0, 2]:
+        weight = torch.stack([block.update_net[i].weight for block in blocks])
+        bias = torch.stack([block.update_net[i].bias for block in blocks])
+        x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+        if i == 0:
+            x = blocks[0].update_net[1](x)
+    x, v = torch.split(x, blocks[0].out_channels, dim=-1)
+    v = v.unsqueeze(2) * vec2
+
+    if blocks[0].act is not None:
+        x = blocks[0].act(x)
+    return x, v
+
+
+rbf_class_mapping = {
+    "gauss": GaussianSmearing,
+    "expnorm": ExpNormalSmearing,
+    "gauss_tab": TabulatedGaussianSmearing,
+    "expnorm_tab": TabulatedExpNormalSmearing,
+}
 
 act_class_mapping = {
     "ssp": ShiftedSoftplus,
@@ -1,4 +1,6 @@
 from abc import abstractmethod, ABCMeta
+from typing import Optional
+import torch
 from torch import nn
 
 
@@ -26,26 +28,18 @@ class BaseWrapper(nn.Module, metaclass=ABCMeta):
 
 
 class AtomFilter(BaseWrapper):
+    r"""Excludes atoms with :obj:`z <= remove_threshold` from the reduction to molecular
+    predictions and from the center of mass of the output models. The atoms are not
+    removed here, :class:`TorchMD_Net` masks them (see
+    :func:`torchmdnet.models.model.aggregate`), which keeps all shapes static and
+    avoids device synchronizations. That every molecule keeps at least one atom is
+    checked when the data is loaded.
+    """
+
     def __init__(self, model, remove_threshold):
         super(AtomFilter, self).__init__(model)
         self.remove_threshold = remove_threshold
 
-    def forward(self, z, pos, batch=None):
-        x, v, z, pos, batch = self.model(z, pos, batch=batch)
-
-        n_samples = len(batch.unique())
-
-        # drop atoms according to the filter
-        atom_mask = z > self.remove_threshold
-        x = x[atom_mask]
-        if v is not None:
-            v = v[atom_mask]
-        z = z[atom_mask]
-        pos = pos[atom_mask]
-        batch = batch[atom_mask]
-
-        assert len(batch.unique()) == n_samples, (
-            "Some samples were completely filtered out by the atom filter. "
-            f"Make sure that at least one atom per sample exists with Z > {self.remove_threshold}."
-        )
-        return x, v, z, pos, batch
+    def forward(self, z, pos, batch: Optional[torch.Tensor] = None):
+        batch = torch.zeros_like(z) if batch is None else batch
+        return self.model(z, pos, batch=batch)
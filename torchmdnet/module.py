@@ -4,7 +4,9 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau, CosineAnnealingLR, Cosin
 from torch.nn.functional import mse_loss, l1_loss, smooth_l1_loss
 
 from pytorch_lightning import LightningModule
-from torchmdnet.models.model import create_model, load_model
+from torchmdnet.models.model import create_model, load_model, CompiledForward
+from torchmdnet.utils import MetricAccumulator
+from torchmdnet import profiling
 from math import inf
 
 
@@ -59,6 +61,12 @@ class LNNP(LightningModule):
         self.losses = None
         self._reset_losses_dict()
 
+        # per-step training metrics, reduced over ranks every metrics_sync_interval steps
+        self.step_metrics = MetricAccumulator(
+            [key + "_per_step" for key in self.losses.keys if key.startswith("train")]
+            + ["batch_pos_mean"]
+        )
+
         self.last_epoch = 0
         self.lr_gen_scheduler = PlateauScheduler(
             factor=self.hparams.lr_factor,
@@ -66,6 +74,22 @@ class LNNP(LightningModule):
         )
         self.val_loss = None
 
+        # gradient accumulation: atom/molecule counts of the training micro-batches of the
+        # current window and their detached spectra features, used as extra negatives
+        self.accum_atoms = 0
+        self.accum_molecules = 0
+        self.accum_batches = 0
+        self.ctr_negatives = []
+
+        # optionally compile the forward pass and the contrastive loss
+        self.compiled_forward = None
+        self.compiled_ctr_loss = None
+        if self.hparams.compile:
+            self.compiled_forward = CompiledForward(
+                self.model, self.hparams.cutoff_upper, self.hparams.compile_bucket_size
+            )
+            self.compiled_ctr_loss = torch.compile(self.ctr_loss_fn, dynamic=True)
+
     def configure_optimizers(self):
         optimizer = AdamW(
             self.model.parameters(),
@@ -104,11 +128,22 @@ class LNNP(LightningModule):
             raise ValueError(f"Unknown lr_schedule: {self.hparams.lr_schedule}")
         return [optimizer], [lr_scheduler]
 
-    def forward(self, z, pos, spec, batch=None):
+    def forward(self, z, pos, spec, batch=None, num_graphs=None):
+        if self.compiled_forward is not None and batch is not None and num_graphs is not None:
+            return self.compiled_forward(z, pos, spec, batch, num_graphs)
         return self.model(z, pos, spec, batch=batch)
 
     def training_step(self, batch, batch_idx):
-        return self.step(batch, mse_loss, "train")
+        if batch_idx % self.hparams.accumulate_grad_batches == 0:
+            # a new gradient accumulation window starts
+            self.accum_atoms = 0
+            self.accum_molecules = 0
+            self.accum_batches = 0
+            self.ctr_negatives = []
+        loss = self.step(batch, mse_loss, "train")
+        if (batch_idx + 1) % self.hparams.metrics_sync_interval == 0:
+            self._log_step_metrics()
+        return loss
 
     def validation_step(self, batch, batch_idx, *args):
         if len(args) == 0 or (len(args) > 0 and args[0] == 0):
@@ -120,16 +155,30 @@ class LNNP(LightningModule):
         return self.step(batch, l1_loss, "test")
 
     def step(self, batch, loss_fn, stage):
-        with torch.set_grad_enabled(stage == "train" or self.hparams.derivative):
+        bf16 = self.hparams.precision == "bf16"
+        with torch.set_grad_enabled(stage == "train" or self.hparams.derivative), torch.autocast(
+            device_type=self.device.type, dtype=torch.bfloat16, enabled=bf16
+        ):
             if ("uv" in batch) and ("ir" in batch) and ("raman" in batch): 
-                pred, noise_pred, deriv, sp_feature, molecule_feature, loss_reconstruct = self(batch.z, batch.pos, [batch.uv, batch.ir, batch.raman], batch.batch)
+                spec = [batch.uv, batch.ir, batch.raman]
             elif ("ir" in batch) and ("h_nmr" in batch) and ("c_nmr" in batch):
-                pred, noise_pred, deriv, sp_feature, molecule_feature, loss_reconstruct = self(batch.z, batch.pos, [batch.ir, batch.h_nmr, batch.c_nmr], batch.batch)
+                spec = [batch.ir, batch.h_nmr, batch.c_nmr]
             else:
-                pred, noise_pred, deriv, sp_feature, molecule_feature, loss_reconstruct = self(batch.z, batch.pos, None, batch.batch)
+                spec = None
+            with profiling.stage("forward"):
+                pred, noise_pred, deriv, sp_feature, molecule_feature, loss_reconstruct = self(
+                    batch.z, batch.pos, spec, batch.batch, num_graphs=batch.num_graphs
+                )
+
+        if bf16:
+            # losses are computed in float32
+            pred, noise_pred, deriv, sp_feature, molecule_feature = [
+                out.float() if out is not None else None
+                for out in (pred, noise_pred, deriv, sp_feature, molecule_feature)
+            ]
 
         if loss_reconstruct is not None and self.hparams.reconstruct_weight > 0:
-            self.losses[stage + "_reconstruct"].append(loss_reconstruct.detach())
+            self._record_loss(stage + "_reconstruct", loss_reconstruct)
         else:
             loss_reconstruct = 0
 
@@ -160,7 +209,7 @@ class LNNP(LightningModule):
                 self.ema[stage + "_dy"] = loss_dy.detach()
 
             if self.hparams.force_weight > 0:
-                self.losses[stage + "_dy"].append(loss_dy.detach())
+                self._record_loss(stage + "_dy", loss_dy)
 
         if "y" in batch:
             if (noise_pred is not None) and not denoising_is_on:
@@ -184,7 +233,7 @@ class LNNP(LightningModule):
                 self.ema[stage + "_y"] = loss_y.detach()
 
             if self.hparams.energy_weight > 0:
-                self.losses[stage + "_y"].append(loss_y.detach())
+                self._record_loss(stage + "_y", loss_y)
 
         if denoising_is_on:
             if "y" not in batch:
@@ -193,12 +242,21 @@ class LNNP(LightningModule):
 
             normalized_pos_target = self.model.pos_normalizer(batch.pos_target)
             loss_pos = loss_fn(noise_pred, normalized_pos_target)
-            self.losses[stage + "_pos"].append(loss_pos.detach())
+            self._record_loss(stage + "_pos", loss_pos)
 
         # contrastive loss
         if contrastive_is_on:
-            loss_ctr = self.ctr_loss_fn(molecule_feature, sp_feature)
-            self.losses[stage + "_contrast"].append(loss_ctr.detach())
+            ctr_loss_fn = self.compiled_ctr_loss if self.compiled_ctr_loss is not None else self.ctr_loss_fn
+            accumulating = stage == "train" and self.hparams.accumulate_grad_batches > 1
+            negatives = None
+            if accumulating and len(self.ctr_negatives) > 0:
+                # spectra of the previous micro-batches of the window are additional negatives
+                negatives = torch.cat(self.ctr_negatives)
+            with profiling.stage("contrastive_loss"):
+                loss_ctr = ctr_loss_fn(molecule_feature, sp_feature, extra_negatives=negatives)
+            if accumulating:
+                self.ctr_negatives.append(sp_feature.detach())
+            self._record_loss(stage + "_contrast", loss_ctr)
 
         # total loss
         loss = (
@@ -208,18 +266,50 @@ class LNNP(LightningModule):
             + loss_ctr * self.hparams.contrastive_weight \
             + loss_reconstruct * self.hparams.reconstruct_weight
         )
-        self.losses[stage].append(loss.detach())
+        self._record_loss(stage, loss)
 
-        # Frequent per-batch logging for training
+        # Frequent per-batch logging for training, accumulated on the device
         if stage == 'train':
-            train_metrics = {k + "_per_step": v[-1] for k, v in self.losses.items() if (k.startswith("train") and len(v) > 0)}
-            train_metrics['lr_per_step'] = self.trainer.optimizers[0].param_groups[0]["lr"]
-            train_metrics['step'] = self.trainer.global_step   
-            train_metrics['batch_pos_mean'] = batch.pos.mean().item()
-            self.log_dict(train_metrics, sync_dist=True)
+            self.step_metrics.update("batch_pos_mean", batch.pos.mean())
+
+        if stage == "train" and self.hparams.accumulate_grad_batches > 1:
+            # weight the micro-batch by its number of atoms and molecules, so that the
+            # accumulated gradient averages over the atoms and molecules of the window
+            atom_weight, molecule_weight = self._micro_batch_weights(batch)
+            loss = (
+                loss_y * self.hparams.energy_weight * molecule_weight \
+                + loss_dy * self.hparams.force_weight * atom_weight \
+                + loss_pos * self.hparams.denoising_weight * atom_weight \
+                + loss_ctr * self.hparams.contrastive_weight * molecule_weight \
+                + loss_reconstruct * self.hparams.reconstruct_weight * molecule_weight
+            )
 
         return loss
 
+    def _micro_batch_weights(self, batch):
+        # relative to the mean micro-batch of the window so far, known on the host without
+        # a sync; the first micro-batch of every window has the weight 1
+        self.accum_atoms += batch.z.size(0)
+        self.accum_molecules += batch.num_graphs
+        self.accum_batches += 1
+        atom_weight = batch.z.size(0) * self.accum_batches / self.accum_atoms
+        molecule_weight = batch.num_graphs * self.accum_batches / self.accum_molecules
+        return atom_weight, molecule_weight
+
+    def _record_loss(self, key, value):
+        self.losses.update(key, value)
+        if key.startswith("train"):
+            self.step_metrics.update(key + "_per_step", value)
+
+    def _log_step_metrics(self):
+        # metrics are averaged over the steps since the last call and over all ranks
+        with profiling.stage("logging"):
+            train_metrics = self.step_metrics.compute(self.device)
+            self.step_metrics.reset()
+            train_metrics['lr_per_step'] = self.trainer.optimizers[0].param_groups[0]["lr"]
+            train_metrics['step'] = self.trainer.global_step
+            self.log_dict(train_metrics)
+
     def optimizer_step(self, *args, **kwargs):
         epoch = kwargs["epoch"] if "epoch" in kwargs else args[0]
         bach_idx = kwargs["batch_idx"] if "batch_idx" in kwargs else args[1]
@@ -248,6 +338,10 @@ class LNNP(LightningModule):
         optimizer.zero_grad()
 
     def training_epoch_end(self, training_step_outputs):
+        # the remaining steps of the epoch, on every rank as the metrics are all-reduced;
+        # the number of steps is not known in advance for streamed datasets
+        self._log_step_metrics()
+
         dm = self.trainer.datamodule
         if hasattr(dm, "test_dataset") and len(dm.test_dataset) > 0:
             should_reset = (
@@ -259,127 +353,72 @@ class LNNP(LightningModule):
 
     def validation_epoch_end(self, validation_step_outputs):
         if not self.trainer.running_sanity_check:
+            # mean losses of the epoch over all ranks
+            losses = self.losses.compute(self.device)
             result_dict = {
                 "epoch": self.current_epoch,
                 "lr": self.trainer.optimizers[0].param_groups[0]["lr"],
-                "train_loss": torch.stack(self.losses["train"]).mean(),
-                "val_loss": torch.stack(self.losses["val"]).mean(),
+                "train_loss": losses["train"],
+                "val_loss": losses["val"],
             }
             self.val_loss = result_dict["val_loss"]
 
             # add test loss if available
-            if len(self.losses["test"]) > 0:
-                result_dict["test_loss"] = torch.stack(self.losses["test"]).mean()
-
-            # if prediction and derivative are present, also log them separately
-            if len(self.losses["train_y"]) > 0 and len(self.losses["train_dy"]) > 0:
-                result_dict["train_loss_y"] = torch.stack(self.losses["train_y"]).mean()
-                result_dict["train_loss_dy"] = torch.stack(
-                    self.losses["train_dy"]
-                ).mean()
-                result_dict["val_loss_y"] = torch.stack(self.losses["val_y"]).mean()
-                result_dict["val_loss_dy"] = torch.stack(self.losses["val_dy"]).mean()
-
-                if len(self.losses["test"]) > 0:
-                    result_dict["test_loss_y"] = torch.stack(
-                        self.losses["test_y"]
-                    ).mean()
-                    result_dict["test_loss_dy"] = torch.stack(
-                        self.losses["test_dy"]
-                    ).mean()
-
-            if len(self.losses["train_y"]) > 0:
-                result_dict["train_loss_y"] = torch.stack(self.losses["train_y"]).mean()
-            if len(self.losses['val_y']) > 0:
-                result_dict["val_loss_y"] = torch.stack(self.losses["val_y"]).mean()
-            if len(self.losses["test_y"]) > 0:
-                result_dict["test_loss_y"] = torch.stack(
-                    self.losses["test_y"]
-                ).mean()
-
-            # if denoising is present, also log it
-            if len(self.losses["train_pos"]) > 0:
-                result_dict["train_loss_pos"] = torch.stack(
-                    self.losses["train_pos"]
-                ).mean()
-
-            if len(self.losses["val_pos"]) > 0:
-                result_dict["val_loss_pos"] = torch.stack(
-                    self.losses["val_pos"]
-                ).mean()
-
-            if len(self.losses["test_pos"]) > 0:
-                result_dict["test_loss_pos"] = torch.stack(
-                    self.losses["test_pos"]
-                ).mean()
-
-            # if contrast is present, also log it
-            if len(self.losses["train_contrast"]) > 0:
-                result_dict["train_loss_contrast"] = torch.stack(
-                    self.losses["train_contrast"]
-                ).mean()
-
-            if len(self.losses["val_contrast"]) > 0:
-                result_dict["val_loss_contrast"] = torch.stack(
-                    self.losses["val_contrast"]
-                ).mean()
-
-            if len(self.losses["test_contrast"]) > 0:
-                result_dict["test_loss_contrast"] = torch.stack(
-                    self.losses["test_contrast"]
-                ).mean()
-
-            # if reconstruct is present, also log it
-            if len(self.losses["train_reconstruct"]) > 0:
-                result_dict["train_loss_reconstruct"] = torch.stack(
-                    self.losses["train_reconstruct"]
-                ).mean()
-
-            if len(self.losses["val_reconstruct"]) > 0:
-                result_dict["val_loss_reconstruct"] = torch.stack(
-                    self.losses["val_reconstruct"]
-                ).mean()
-
-            if len(self.losses["test_reconstruct"]) > 0:
-                result_dict["test_loss_reconstruct"] = torch.stack(
-                    self.losses["test_reconstruct"]
-                ).mean()
-
-            self.log_dict(result_dict, sync_dist=True)
+            if "test" in losses:
+                result_dict["test_loss"] = losses["test"]
+
+            # if prediction and derivative are present, also log the derivative separately
+            if "train_y" in losses and "train_dy" in losses:
+                for stage in ["train", "val", "test"]:
+                    if stage + "_dy" in losses:
+                        result_dict[stage + "_loss_dy"] = losses[stage + "_dy"]
+
+            # log prediction, denoising, contrast and reconstruct losses if present
+            for name in ["y", "pos", "contrast", "reconstruct"]:
+                for stage in ["train", "val", "test"]:
+                    if stage + "_" + name in losses:
+                        result_dict[stage + "_loss_" + name] = losses[stage + "_" + name]
+
+            self.log_dict(result_dict)
         self._reset_losses_dict()
 
     def _reset_losses_dict(self):
-        self.losses = {
-            "train": [],
-            "val": [],
-            "test": [],
-            "train_y": [],
-            "val_y": [],
-            "test_y": [],
-            "train_dy": [],
-            "val_dy": [],
-            "test_dy": [],
-            "train_pos": [],
-            "val_pos": [],
-            "test_pos": [],
-            "train_contrast": [],
-            "val_contrast": [],
-            "test_contrast": [],
-            "train_reconstruct": [],
-            "val_reconstruct": [],
-            "test_reconstruct": [],
-        }
+        # running mean of every loss over the epoch, constant memory per loss
+        self.losses = MetricAccumulator([
+            "train",
+            "val",
+            "test",
+            "train_y",
+            "val_y",
+            "test_y",
+            "train_dy",
+            "val_dy",
+            "test_dy",
+            "train_pos",
+            "val_pos",
+            "test_pos",
+            "train_contrast",
+            "val_contrast",
+            "test_contrast",
+            "train_reconstruct",
+            "val_reconstruct",
+            "test_reconstruct",
+        ])
 
     def _reset_ema_dict(self):
         self.ema = {"train_y": None, "val_y": None, "train_dy": None, "val_dy": None}
 
-    def ctr_loss_fn(self, molecule_feature, sp_feature, temperature=0.07):
+    def ctr_loss_fn(self, molecule_feature, sp_feature, temperature=0.07, extra_negatives=None):
         from torch.nn import functional as F
 
+        # spectra features of other molecules, e.g. cached from previous micro-batches
+        if extra_negatives is not None:
+            sp_feature = torch.cat([sp_feature, extra_negatives])
+
         # Calculate cosine similarity
         cos_sim = F.cosine_similarity(molecule_feature[:, None, :], sp_feature[None, :, :], dim=-1)
 
-        postive_mask = torch.eye(cos_sim.shape[0], dtype=torch.bool, device=cos_sim.device)
+        postive_mask = torch.eye(cos_sim.shape[0], cos_sim.shape[1], dtype=torch.bool, device=cos_sim.device)
         # InfoNCE loss
         cos_sim = cos_sim / temperature
         nll = -cos_sim[postive_mask] + torch.logsumexp(cos_sim, dim=-1)
@@ -1,15 +1,18 @@
 import torch as pt
-from NNPOps.CFConv import CFConv
-from NNPOps.CFConvNeighbors import CFConvNeighbors
+from torch_scatter import segment_csr
 
 from .models.model import TorchMD_Net
 from .models.torchmd_gn import TorchMD_GN
+from .models.utils import mirror_edges
 
 
 class TorchMD_GN_optimized(pt.nn.Module):
 
     def __init__(self, model):
 
+        from NNPOps.CFConv import CFConv
+        from NNPOps.CFConvNeighbors import CFConvNeighbors
+
         if model.rbf_type != 'gauss':
             raise ValueError('Only rbf_type="gauss" is supproted')
         if model.trainable_rbf:
@@ -55,13 +58,94 @@ class TorchMD_GN_optimized(pt.nn.Module):
         return 'Optimized: ' + repr(self.model)
 
 
-def optimize(model):
+class TorchMD_GN_CSR(pt.nn.Module):
+    """
+    Pure PyTorch inference engine for TorchMD_GN, a drop-in replacement of
+    TorchMD_GN_optimized for batched inputs, any RBF and activation and CPUs.
+
+    The edges are sorted by their target atom once per call, so that the neighbors
+    of every atom are a contiguous segment (CSR layout) aggregated with segment_csr.
+    The distance expansion and cutoff are computed once and the filter networks of
+    all interaction blocks are evaluated together as batched matrix products, with
+    the cutoff multiplied into the filters.
+    """
+
+    def __init__(self, model):
+
+        if model.aggr not in ['add', 'mean', 'max']:
+            raise ValueError(f'Unsupported aggr="{model.aggr}"')
+
+        super().__init__()
+        self.model = model
+        self.reduce = 'sum' if model.aggr == 'add' else model.aggr
+
+    def _filters(self, edge_attr, C):
+        # first and second layers of all filter networks as one matrix product each
+        mlps = [inter.mlp for inter in self.model.interactions]
+        w1 = pt.cat([mlp[0].weight for mlp in mlps])
+        b1 = pt.cat([mlp[0].bias for mlp in mlps])
+        h = mlps[0][1](pt.nn.functional.linear(edge_attr, w1, b1))
+        h = h.view(len(edge_attr), len(mlps), -1).transpose(0, 1)
+        w2 = pt.stack([mlp[2].weight.T for mlp in mlps])
+        b2 = pt.stack([mlp[2].bias for mlp in mlps])
+        return pt.baddbmm(b2.unsqueeze(1), h, w2) * C.view(1, -1, 1)
+
+    def forward(self, z, pos, batch):
+
+        model = self.model
+        x = model.embedding(z)
+
+        edge_index, edge_weight, _ = model.distance(pos, batch)
+        # features are computed per pair and gathered in the edge order
+        edge_attr = model.distance_expansion(edge_weight)
+        # all cutoffs of the model share the same bounds
+        C = model.interactions[0].conv.cutoff(edge_weight)
+
+        edge_map = pt.arange(edge_index.size(1), device=edge_index.device)
+        if model.half_edges:
+            edge_index, edge_map, _ = mirror_edges(edge_index)
+        order = pt.argsort(edge_index[1])
+        source, edge_map = edge_index[0, order], edge_map[order]
+        counts = pt.bincount(edge_index[1], minlength=len(z))
+        ptr = pt.cat([counts.new_zeros(1), counts.cumsum(0)])
+
+        if model.neighbor_embedding is not None:
+            ne = model.neighbor_embedding
+            W = (ne.distance_proj(edge_attr) * C.view(-1, 1))[edge_map]
+            x_neighbors = segment_csr(ne.embedding(z)[source] * W, ptr, reduce='sum')
+            x = ne.combine(pt.cat([x, x_neighbors], dim=1))
+
+        filters = self._filters(edge_attr, C)
+        for inter, W in zip(model.interactions, filters):
+            y = inter.conv.lin1(x)
+            y = segment_csr(y[source] * W[edge_map], ptr, reduce=self.reduce)
+            y = inter.conv.lin2(y)
+            y = inter.act(y)
+            x = x + inter.lin(y)
+
+        return x, None, z, pos, batch
+
+    def __repr__(self):
+        return 'Optimized (CSR): ' + repr(self.model)
+
+
+def optimize(model, backend='nnpops'):
+    """
+    Replaces the representation model of a TorchMD_Net with an optimized engine.
+    backend='nnpops' uses the CUDA kernels of NNPOps (single molecule, gauss RBF and
+    ssp activation only), backend='csr' the pure PyTorch TorchMD_GN_CSR.
+    """
 
     assert isinstance(model, TorchMD_Net)
 
-    if isinstance(model.representation_model, TorchMD_GN):
+    if not isinstance(model.representation_model, TorchMD_GN):
+        raise ValueError('Unsupported model! Only TorchMD_GN is suppored.')
+
+    if backend == 'nnpops':
         model.representation_model = TorchMD_GN_optimized(model.representation_model)
+    elif backend == 'csr':
+        model.representation_model = TorchMD_GN_CSR(model.representation_model)
     else:
-        raise ValueError('Unsupported model! Only TorchMD_GN is suppored.')
+        raise ValueError(f'Unknown backend "{backend}"')
 
     return model
\ No newline at end of file
@@ -1,4 +1,5 @@
 from abc import abstractmethod, ABCMeta
+from typing import Optional
 import torch
 from torch import nn
 from pytorch_lightning.utilities import rank_zero_warn
@@ -40,6 +41,13 @@ class BasePrior(nn.Module, metaclass=ABCMeta):
         """
         return
 
+    def scale_and_apply(self, x, std: Optional[torch.Tensor], z, pos, batch):
+        r"""Scales the predictions by the data standard deviation and applies the prior.
+        Priors can override this to fuse both steps."""
+        if std is not None:
+            x = x * std
+        return self.forward(x, z, pos, batch)
+
 
 class Atomref(BasePrior):
     r"""Atomref prior model.
@@ -76,3 +84,9 @@ class Atomref(BasePrior):
 
     def forward(self, x, z, pos, batch):
         return x + self.atomref(z)
+
+    def scale_and_apply(self, x, std: Optional[torch.Tensor], z, pos, batch):
+        atomref = self.atomref.weight.index_select(0, z)
+        if std is None:
+            return x + atomref
+        return torch.addcmul(atomref, x, std)
@@ -0,0 +1,172 @@
+import csv
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from os.path import join
+import torch
+from pytorch_lightning import Callback
+
+
+_timer = None
+_off = nullcontext()
+
+
+def stage(name):
+    r"""Context manager marking a stage of the training step. Adds a named range to the
+    PyTorch profiler trace and measures the wall-clock time of the stage while stage
+    profiling is enabled (see :class:`StageProfiler`), does nothing otherwise."""
+    if _timer is None:
+        return _off
+    return _timer.stage(name)
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.range = torch.autograd.profiler.record_function(name)
+
+    def __enter__(self):
+        self.range.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.synchronize:
+            # wait for the kernels of the stage, otherwise only the launches are timed
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        self.range.__exit__(*exc)
+
+
+class StageTimer(object):
+    r"""Accumulates the wall-clock time of named stages.
+
+    Args:
+        synchronize (bool, optional): Synchronize CUDA at the end of every stage, so
+            that the time of the stage's kernels is measured. (default: :obj:`True`)
+    """
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.times = defaultdict(list)
+        self._open = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        self.times[name].append(seconds)
+
+    def attach(self, module, name):
+        r"""Times every forward call of :obj:`module` as the stage :obj:`name`, without
+        changing the module. Returns the hook handles."""
+
+        def enter(module, inputs):
+            context = self.stage(name)
+            context.__enter__()
+            self._open.append(context)
+
+        def exit(module, inputs, output):
+            self._open.pop().__exit__(None, None, None)
+
+        return [module.register_forward_pre_hook(enter), module.register_forward_hook(exit)]
+
+    def summary(self):
+        r"""Returns one row per stage with the number of calls and the total and mean
+        time in milliseconds, sorted by total time. Times of nested stages are included
+        in the enclosing stage."""
+        rows = []
+        for name, times in self.times.items():
+            total = sum(times) * 1e3
+            rows.append(dict(stage=name, calls=len(times), total_ms=total, mean_ms=total / len(times)))
+        return sorted(rows, key=lambda row: -row["total_ms"])
+
+    def write_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "calls", "total_ms", "mean_ms"])
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+
+def _representation_stages(model):
+    # submodules of the representation models timed with hooks, they are also
+    # used in TorchScript and can therefore not contain stage() calls
+    from torchmdnet.models.utils import Distance, NeighborEmbedding
+    from torchmdnet.models.torchmd_et import EquivariantMultiHeadAttention, EquivariantLayerNorm
+
+    stages = [
+        (Distance, "radius_graph"),
+        (NeighborEmbedding, "neighbor_embedding"),
+        (EquivariantMultiHeadAttention, "attention_layer"),
+        (EquivariantLayerNorm, "equivariant_layernorm"),
+    ]
+    for module in model.modules():
+        for cls, name in stages:
+            if isinstance(module, cls):
+                yield module, name
+
+
+class StageProfiler(Callback):
+    r"""Profiles the training steps :obj:`wait` to :obj:`wait + active`.
+
+    During these steps the stages marked with :func:`stage` and the submodules of the
+    representation model (neighbor search, attention layers and layer norms) are
+    timed and recorded with :class:`torch.profiler.profile`. Afterwards a Chrome trace
+    (:obj:`trace-rank<r>.json`) and a CSV summary of the stages
+    (:obj:`stages-rank<r>.csv`) are written to :obj:`log_dir`. Profiling adds no
+    overhead outside of these steps.
+
+    Args:
+        log_dir (str): Output directory.
+        wait (int, optional): Number of steps skipped before profiling, e.g. for
+            warm-up and compilation. (default: :obj:`10`)
+        active (int, optional): Number of profiled steps. (default: :obj:`20`)
+    """
+
+    def __init__(self, log_dir, wait=10, active=20):
+        self.log_dir = log_dir
+        self.wait = wait
+        self.active = active
+        self.timer = None
+        self.profiler = None
+        self.hooks = []
+        self.steps = 0
+
+    def _start(self, pl_module):
+        global _timer
+        self.timer = StageTimer()
+        for module, name in _representation_stages(pl_module.model.representation_model):
+            self.hooks.extend(self.timer.attach(module, name))
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities)
+        self.profiler.__enter__()
+        _timer = self.timer
+
+    def _stop(self, trainer):
+        global _timer
+        _timer = None
+        self.profiler.__exit__(None, None, None)
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+        rank = trainer.global_rank
+        self.profiler.export_chrome_trace(join(self.log_dir, f"trace-rank{rank}.json"))
+        self.timer.write_csv(join(self.log_dir, f"stages-rank{rank}.csv"))
+        self.profiler = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx):
+        if self.steps == self.wait:
+            self._start(pl_module)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx):
+        self.steps += 1
+        if self.profiler is not None and self.steps == self.wait + self.active:
+            self._stop(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        # training ended before all steps were profiled
+        if self.profiler is not None:
+            self._stop(trainer)
@@ -0,0 +1,167 @@
+import torch
+from torch.nn import functional as F
+
+
+def exact_search(database, queries, k, chunk_size=4096):
+    r"""Brute force cosine similarity search. Returns the scores and the row indices of
+    the :obj:`k` most similar database entries of every query."""
+    database = F.normalize(database.float(), dim=-1)
+    scores, indices = [], []
+    for q in torch.split(F.normalize(queries.float(), dim=-1), chunk_size):
+        s, i = (q @ database.T).topk(min(k, len(database)), dim=-1)
+        scores.append(s)
+        indices.append(i)
+    return torch.cat(scores), torch.cat(indices)
+
+
+class IVFIndex(object):
+    r"""Inverted file index for approximate cosine similarity search.
+
+    The database is partitioned into :obj:`num_lists` clusters with spherical k-means.
+    A query is only compared with the entries of the :obj:`num_probes` clusters whose
+    centroids are closest to it. Entries are stored sorted by cluster, so that every
+    cluster is a contiguous slice of the storage.
+
+    Args:
+        num_lists (int, optional): Number of clusters. (default: :obj:`256`)
+        num_probes (int, optional): Number of clusters searched per query.
+            (default: :obj:`8`)
+        device (str, optional): Device of the index. (default: :obj:`"cpu"`)
+        dtype (torch.dtype, optional): Storage type of the entries, the similarities
+            are computed in this type. (default: :obj:`torch.float16` on GPU and
+            :obj:`torch.float32` otherwise)
+    """
+
+    def __init__(self, num_lists=256, num_probes=8, device="cpu", dtype=None):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.device = torch.device(device)
+        if dtype is None:
+            dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        self.dtype = dtype
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def _prepare(self, x):
+        return F.normalize(torch.as_tensor(x).to(self.device, torch.float32), dim=-1)
+
+    def _assign(self, x, chunk_size=65536):
+        return torch.cat([(c @ self.centroids.T).argmax(dim=-1) for c in torch.split(x, chunk_size)])
+
+    def train(self, x, num_iters=20, seed=0):
+        r"""Computes the cluster centroids of the (sample of) database entries :obj:`x`."""
+        x = self._prepare(x)
+        assert len(x) >= self.num_lists, "At least num_lists entries are required to train the index."
+        generator = torch.Generator().manual_seed(seed)
+        self.centroids = x[torch.randperm(len(x), generator=generator)[: self.num_lists].to(self.device)]
+        for _ in range(num_iters):
+            assignment = self._assign(x)
+            sums = torch.zeros_like(self.centroids).index_add_(0, assignment, x)
+            counts = torch.bincount(assignment, minlength=self.num_lists)
+            # empty clusters are restarted at random entries
+            empty = counts == 0
+            sums[empty] = x[torch.randint(len(x), (int(empty.sum()),), generator=generator).to(self.device)]
+            self.centroids = F.normalize(sums, dim=-1)
+        return self
+
+    def add(self, x, ids=None):
+        r"""Adds the entries :obj:`x` with the identifiers :obj:`ids` to the index. The
+        identifiers default to consecutive numbers."""
+        assert self.centroids is not None, "The index has to be trained before adding entries."
+        x = self._prepare(x)
+        if ids is None:
+            ids = torch.arange(len(self), len(self) + len(x))
+        ids = torch.as_tensor(ids, dtype=torch.long, device=self.device)
+        assignment = self._assign(x)
+
+        if self.vectors is not None:
+            # merge with the existing entries
+            x = torch.cat([self.vectors.float(), x])
+            ids = torch.cat([self.ids, ids])
+            counts = self.offsets[1:] - self.offsets[:-1]
+            assignment = torch.cat([torch.repeat_interleave(torch.arange(self.num_lists, device=self.device), counts), assignment])
+
+        order = torch.argsort(assignment, stable=True)
+        self.vectors = x[order].to(self.dtype)
+        self.ids = ids[order]
+        counts = torch.bincount(assignment, minlength=self.num_lists)
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        return self
+
+    def search(self, queries, k):
+        r"""Returns the similarities and identifiers of the :obj:`k` most similar
+        entries of every query, sorted by decreasing similarity. Missing results have
+        the identifier :obj:`-1`."""
+        queries = self._prepare(queries)
+        scores = queries.new_full((len(queries), k), -float("inf"))
+        ids = torch.full((len(queries), k), -1, dtype=torch.long, device=self.device)
+        if len(self) == 0:
+            return scores, ids
+
+        probes = (queries @ self.centroids.T).topk(min(self.num_probes, self.num_lists), dim=-1).indices
+        # visit every probed cluster once with all queries probing it
+        order = torch.argsort(probes.flatten())
+        probe_lists, probe_queries = probes.flatten()[order], order // probes.shape[1]
+        lists, counts = torch.unique_consecutive(probe_lists, return_counts=True)
+        offsets = self.offsets.tolist()
+        queries = queries.to(self.dtype)
+        for l, q in zip(lists.tolist(), torch.split(probe_queries, counts.tolist())):
+            start, stop = offsets[l], offsets[l + 1]
+            if start == stop:
+                continue
+            s, i = (queries[q] @ self.vectors[start:stop].T).float().topk(min(k, stop - start), dim=-1)
+            s = torch.cat([scores[q], s], dim=-1)
+            i = torch.cat([ids[q], self.ids[start + i]], dim=-1)
+            s, best = s.topk(k, dim=-1)
+            scores[q], ids[q] = s, i.gather(1, best)
+        return scores, ids
+
+    def state_dict(self):
+        return dict(
+            num_lists=self.num_lists,
+            num_probes=self.num_probes,
+            dtype=self.dtype,
+            centroids=self.centroids,
+            vectors=self.vectors,
+            ids=self.ids,
+            offsets=self.offsets,
+        )
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        state = torch.load(path, map_location=device)
+        index = cls(state["num_lists"], state["num_probes"], device=device, dtype=state["dtype"])
+        for key in ["centroids", "vectors", "ids", "offsets"]:
+            setattr(index, key, state[key])
+        return index
+
+
+class SpectrumRetriever(object):
+    r"""Retrieves the structures matching measured spectra. Spectra are encoded with the
+    spectra model of a contrastively trained :class:`TorchMD_Net` and looked up in an
+    index of its molecule embeddings, e.g. built from an :class:`EmbeddingStore`.
+
+    Args:
+        model (TorchMD_Net): Model with a spectra model.
+        index (IVFIndex): Index of molecule embeddings, identified by their dataset index.
+    """
+
+    def __init__(self, model, index):
+        self.model = model.eval()
+        self.index = index
+
+    def __call__(self, spectra, k=10):
+        r"""Returns the similarities and dataset indices of the :obj:`k` best matching
+        molecules for a batch of spectra, given as the list of spectra tensors used
+        during training."""
+        with torch.inference_mode():
+            queries = self.model.spectra_embedding(spectra)
+        return self.index.search(queries, k)
@@ -2,11 +2,12 @@ import yaml
 import argparse
 import numpy as np
 import torch
+import torch.distributed as dist
 from os.path import dirname, join, exists
 from pytorch_lightning.utilities import rank_zero_warn
 
 
-def train_val_test_split(dset_len, train_size, val_size, test_size, seed, order=None):
+def split_sizes(dset_len, train_size, val_size, test_size):
     assert (train_size is None) + (val_size is None) + (
         test_size is None
     ) <= 1, "Only one of train_size, val_size, test_size is allowed to be None."
@@ -47,6 +48,14 @@ def train_val_test_split(dset_len, train_size, val_size, test_size, seed, order=
     )
     if total < dset_len:
         rank_zero_warn(f"{dset_len - total} samples were excluded from the dataset")
+    return train_size, val_size, test_size
+
+
+def train_val_test_split(dset_len, train_size, val_size, test_size, seed, order=None):
+    train_size, val_size, test_size = split_sizes(
+        dset_len, train_size, val_size, test_size
+    )
+    total = train_size + val_size + test_size
 
     idxs = np.arange(dset_len, dtype=int)
     if order is None:
@@ -153,5 +162,53 @@ def number(text):
     return num_float
 
 
+def precision(text):
+    if text == "bf16":
+        return text
+    return int(text)
+
+
+class MetricAccumulator(object):
+    r"""Accumulates scalar metrics as running sums on the device of the logged values
+    and a count per metric. Updating does not synchronize with the host, only
+    :meth:`compute` does, once, with a single all-reduce over all metrics if a
+    process group is initialized. All ranks have to call :meth:`compute` together.
+
+    Args:
+        keys (list of str): Names of the metrics, in the same order on every rank.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.sums = None
+        self.counts = None
+        self.reset()
+
+    def reset(self):
+        self.sums = dict()
+        self.counts = dict.fromkeys(self.keys, 0)
+
+    def update(self, key, value):
+        value = value.detach()
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value
+        else:
+            self.sums[key] = value.float()
+        self.counts[key] += 1
+
+    def compute(self, device):
+        r"""Returns the mean of every metric that was updated on at least one rank."""
+        zero = torch.zeros((), device=device)
+        sums = torch.stack([self.sums.get(key, zero).to(device).reshape(()) for key in self.keys])
+        counts = torch.tensor([self.counts[key] for key in self.keys], dtype=sums.dtype, device=device)
+        if dist.is_available() and dist.is_initialized():
+            totals = torch.stack([sums, counts])
+            dist.all_reduce(totals)
+            sums, counts = totals
+        means = sums / counts.clamp(min=1)
+        updated = (counts > 0).tolist()
+        return {key: means[i] for i, key in enumerate(self.keys) if updated[i]}
+
+
 class MissingEnergyException(Exception):
     pass